@@ -0,0 +1,81 @@
+# File: phantom_breaker.py
+# Copyright (c) 2016-2024 Splunk Inc.
+#
+# SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
+# without a valid written license from Splunk Inc. is PROHIBITED.
+
+import time
+
+try:
+    from .phantom_state import RUN_DIR, state_file, server_key, locked, read_json, write_json
+except:
+    from phantom_state import RUN_DIR, state_file, server_key, locked, read_json, write_json
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# how long the caller that got to probe a server may take before another one can
+PROBE_TIMEOUT = 30
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for one SOAR server, shared through a state file by every
+    process of the app.
+
+    After `threshold` consecutive connection failures the breaker opens and
+    allow() refuses every caller for `cooldown` seconds. After that a single
+    caller is let through as a probe (half-open); its success closes the
+    breaker and its failure opens it for another cooldown.
+    """
+    def __init__(self, server, threshold, cooldown):
+        self.path = state_file(RUN_DIR, 'breaker_{}.json'.format(server_key(server)))
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def _load(self):
+        state = read_json(self.path) or {}
+        state.setdefault('state', CLOSED)
+        state.setdefault('failures', 0)
+        return state
+
+    def state(self):
+        return self._load()['state']
+
+    def allow(self):
+        state = self._load()
+        if state['state'] == CLOSED:
+            return True
+        with locked(self.path):
+            state = self._load()
+            now = time.time()
+            if state['state'] == CLOSED:
+                return True
+            if state['state'] == OPEN and now - state.get('opened_at', 0) < self.cooldown:
+                return False
+            if state['state'] == HALF_OPEN and now < state.get('probe_until', 0):
+                return False
+            state['state'] = HALF_OPEN
+            state['probe_until'] = now + PROBE_TIMEOUT
+            write_json(self.path, state)
+            return True
+
+    def record_success(self):
+        state = self._load()
+        if state['state'] == CLOSED and state['failures'] == 0:
+            return
+        with locked(self.path):
+            write_json(self.path, {'state': CLOSED, 'failures': 0})
+
+    def record_failure(self):
+        """Count a connection failure. Returns True when it opened the breaker."""
+        with locked(self.path):
+            state = self._load()
+            state['failures'] += 1
+            opened = False
+            if state['state'] == HALF_OPEN or (state['state'] == CLOSED and state['failures'] >= self.threshold):
+                state['state'] = OPEN
+                state['opened_at'] = time.time()
+                opened = True
+            write_json(self.path, state)
+            return opened
@@ -0,0 +1,98 @@
+# File: phantom_checkpoint.py
+# Copyright (c) 2016-2024 Splunk Inc.
+#
+# SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
+# without a valid written license from Splunk Inc. is PROHIBITED.
+
+import os
+import hashlib
+import time
+
+try:
+    from .phantom_state import LIB_DIR, state_file, read_json, write_json
+except:
+    from phantom_state import LIB_DIR, state_file, read_json, write_json
+
+CHECKPOINT_DIR = os.path.join(LIB_DIR, 'checkpoints')
+# checkpoints of results files that were never finished are dropped after this long
+CHECKPOINT_TTL = 7 * 86400
+# seconds between checkpoint writes while rows are being delivered
+CHECKPOINT_INTERVAL = 1.0
+# source data identifiers kept for skipping rows delivered after the last write
+POSTED_LIMIT = 10000
+
+
+def results_sid(results_file):
+    # results files live in the search's dispatch directory, named after its sid
+    return os.path.basename(os.path.dirname(os.path.abspath(results_file)))
+
+
+def prune_checkpoints(ttl=CHECKPOINT_TTL):
+    try:
+        names = os.listdir(CHECKPOINT_DIR)
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        path = os.path.join(CHECKPOINT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class ResultsCheckpoint(object):
+    """How far delivery of one results file got: the number of leading rows
+    that are handled and the source data identifiers that were posted.
+
+    A later run over the same results file skips those rows. The checkpoint
+    is removed once the whole file has been handled.
+    """
+    def __init__(self, action, results_file, sid=None):
+        self.sid = sid or results_sid(results_file)
+        key = hashlib.sha256('{}\n{}\n{}'.format(action, self.sid, os.path.basename(results_file)).encode('utf-8')).hexdigest()[:32]
+        self.path = state_file(CHECKPOINT_DIR, '{}.json'.format(key))
+        state = read_json(self.path) or {}
+        if state.get('sid') != self.sid:
+            state = {}
+        self.action = action
+        self.offset = self.resumed = state.get('offset', 0)
+        self.posted = list(state.get('posted', []))
+        self._posted = set(self.posted)
+        self._resumed_posted = frozenset(self.posted)
+        self._saved = 0
+
+    def handled(self, row, sdi=None):
+        """Whether row number `row` (or the row with this sdi) was delivered by an earlier run."""
+        return row < self.resumed or (sdi is not None and sdi in self._resumed_posted)
+
+    def commit(self, offset, sdis=()):
+        # offset None: only record the sdis, as an earlier row is not handled yet
+        if offset is not None:
+            self.offset = max(self.offset, offset)
+        for sdi in sdis:
+            if sdi not in self._posted:
+                self._posted.add(sdi)
+                self.posted.append(sdi)
+        if len(self.posted) > POSTED_LIMIT:
+            self.posted = self.posted[-POSTED_LIMIT:]
+            self._posted = set(self.posted)
+        if time.time() - self._saved >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        write_json(self.path, {
+            'action': self.action,
+            'sid': self.sid,
+            'offset': self.offset,
+            'posted': self.posted,
+        })
+        self._saved = time.time()
+
+    def complete(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        prune_checkpoints()
@@ -8,6 +8,9 @@ import os
 import json
 import logging
 import sys
+import time
+from contextlib import contextmanager
+from functools import partial
 
 if sys.version_info >= (3, 0):
    from io import StringIO
@@ -26,6 +29,21 @@ try:
 except:
     from phantom_splunk import Splunk
 
+try:
+    from .phantom_mapping import CIM_MAPPING_JSON, load_cim_mapping, get_cim_index
+except:
+    from phantom_mapping import CIM_MAPPING_JSON, load_cim_mapping, get_cim_index
+
+try:
+    from .phantom_logging import component_handler
+except:
+    from phantom_logging import component_handler
+
+try:
+    from .phantom_state import RUN_DIR, state_file, read_json, write_json, load_cached, save_cached
+except:
+    from phantom_state import RUN_DIR, state_file, read_json, write_json, load_cached, save_cached
+
 import splunk as splunkmod
 
 PHANTOM_KEY = 'phantom'
@@ -44,8 +62,11 @@ TOKEN_KEY = 'ph-auth-token'
 VERIFY_KEY = 'verify_certs'
 FIELD_MAPPING = 'field_mapping'
 ARTIFACT_AR = 'artifact_ar'
+MAPPING_WORKERS = 'mapping_workers'
 
-TOP_LEVEL_SETTINGS = (PHANTOM_KEY, PHANTOM_AR_KEY, SEVERITIES, SEVERITIES_AR, PLAYBOOKS, PLAYBOOKS_AR, VERSION_KEY, LOGGING_CONFIG, ACCEPTED, VERIFY_KEY, FIELD_MAPPING, ARTIFACT_AR, WORKBOOK_KEY, WORKBOOK_LAST_SYNC_TIME, WORKBOOK_SYNC_KEY)
+# the stanzas a forwarding alert reads besides its own
+FORWARDING_SETTINGS = (PHANTOM_KEY, SEVERITIES, LOGGING_CONFIG, VERIFY_KEY, FIELD_MAPPING, MAPPING_WORKERS)
+TOP_LEVEL_SETTINGS = (PHANTOM_KEY, PHANTOM_AR_KEY, SEVERITIES, SEVERITIES_AR, PLAYBOOKS, PLAYBOOKS_AR, VERSION_KEY, LOGGING_CONFIG, ACCEPTED, VERIFY_KEY, FIELD_MAPPING, ARTIFACT_AR, WORKBOOK_KEY, WORKBOOK_LAST_SYNC_TIME, WORKBOOK_SYNC_KEY, MAPPING_WORKERS)
 
 APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 APPCONF = os.path.join(APP_DIR, 'default', 'app.conf')
@@ -53,8 +74,6 @@ APPCONF = os.path.join(APP_DIR, 'default', 'app.conf')
 OLD_CONFIG_FILE = os.path.join(os.environ['SPLUNK_HOME'], 'etc', 'apps', 'phantom', 'local', 'data', 'config', 'config.json')
 OLDER_CONFIG_FILE = os.path.join(os.environ['SPLUNK_HOME'], 'etc', 'apps', 'phantom', 'config.json')
 
-CIM_MAPPING_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cim_cef.json')
-
 LOG_MAPPING = {
     'INFO': logging.INFO,
     'WARNING': logging.WARNING,
@@ -63,14 +82,109 @@ LOG_MAPPING = {
 
 CONFIG_ENDPOINT = '/servicesNS/nobody/phantom/configs/conf-phantom'
 
+# The decoded conf-phantom stanzas are kept in a snapshot shared by every process
+# and reused until phantom.conf changes on disk, PhantomConfig writes a setting or
+# the snapshot is this old. Auth tokens are never part of it.
+CONFIG_SNAPSHOT_TTL = 300
+CONF_FILES = (os.path.join(APP_DIR, 'default', 'phantom.conf'), os.path.join(APP_DIR, 'local', 'phantom.conf'))
+# FIPS mode only changes with a Splunk restart, so it is cached per splunkd process
+FIPS_CACHE_TTL = 86400
+SPLUNKD_PID_FILE = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'run', 'splunk', 'splunkd.pid')
+
+
+def splunkd_pid():
+    try:
+        with open(SPLUNKD_PID_FILE) as f:
+            return f.readline().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def config_snapshot_file():
+    return state_file(RUN_DIR, 'config_snapshot.json')
+
+
+def invalidate_config_snapshot():
+    try:
+        os.remove(config_snapshot_file())
+    except OSError:
+        pass
+
+
+def search_index_file():
+    return state_file(RUN_DIR, 'search_index.json')
+
+
+def save_search_index(config):
+    # forwarding config stanzas are named by id, this maps search names to them
+    write_json(search_index_file(), dict((v.get('_name'), k) for k, v in config.items() if v and k not in TOP_LEVEL_SETTINGS))
+
+
+def decode_stanzas(entries):
+    config = {}
+    for entry in entries:
+        val = entry.get('content', {}).get('value')
+        if val and entry.get('name') != 'enable_logging':
+            val = json.loads(val)
+        config[entry.get('name', '')] = val
+    return config
+
+
+def conf_stamp():
+    stamp = []
+    for path in CONF_FILES:
+        try:
+            st = os.stat(path)
+            stamp.append([st.st_mtime, st.st_size])
+        except OSError:
+            stamp.append(None)
+    return stamp
+
 def get_safe(d, k, default):
     x = d.get(k)
     if not x:
         x = default
     return x
 
+class ServerConfig(dict):
+    """A server entry of the [phantom] stanza that reads its auth token from
+    the credential store the first time it is used."""
+    def __init__(self, entry, load_token):
+        super(ServerConfig, self).__init__(entry)
+        self._load_token = load_token
+
+    def _token(self):
+        if self._load_token is not None:
+            load, self._load_token = self._load_token, None
+            if not dict.__contains__(self, TOKEN_KEY):
+                dict.__setitem__(self, TOKEN_KEY, load())
+
+    def __getitem__(self, key):
+        if key == TOKEN_KEY:
+            self._token()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == TOKEN_KEY:
+            self._token()
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        if key == TOKEN_KEY:
+            self._load_token = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key == TOKEN_KEY and self._load_token is not None:
+            self._load_token = None
+            if not dict.__contains__(self, key):
+                return
+        dict.__delitem__(self, key)
+
+
 class PhantomConfig(DictMixin):
-    def __init__(self, component_name, session=None):        
+    def __init__(self, component_name, session=None, stanzas=None):
+        # stanzas: load only these conf-phantom stanzas instead of the whole config
         if isinstance(component_name, logging.Logger):
             self.logger = component_name
             self.component_name = self.logger.name
@@ -78,12 +192,37 @@ class PhantomConfig(DictMixin):
             self.component_name = component_name
             self.logger = self.get_logger(self.component_name)
         self.splunk = Splunk(session, self.logger)
-        j = self._get_config()
+        j = self._get_config(stanzas)
         self._config = j
+        self._searches = None
+        # conf-phantom values as they were when the current batch() started
+        self._stored = None
+        self._pending = None
+        self._cim_index = None
+        self._version = None
+        self._fips = None
         log_level = self._config.get('enable_logging', 'INFO')
         self.update_log_level(log_level)
-        self.version = self.get_version()
-        self.fips_is_enabled = self.fips_enabled()
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = self.get_version()
+        return self._version
+
+    @property
+    def fips_is_enabled(self):
+        if self._fips is None:
+            path = state_file(RUN_DIR, 'fips_mode.json')
+            pid = splunkd_pid()
+            cached = load_cached(path, FIPS_CACHE_TTL) if pid else None
+            if isinstance(cached, dict) and cached.get('splunkd') == pid:
+                self._fips = cached['fips']
+            else:
+                self._fips = self.fips_enabled()
+                if pid and getattr(self.splunk, 'fips_mode', None) is not None:
+                    save_cached(path, {'splunkd': pid, 'fips': self._fips})
+        return self._fips
 
     def update_log_level(self, level):
         if level == 1 or level == 'DEBUG':
@@ -103,6 +242,10 @@ class PhantomConfig(DictMixin):
     def get_passwords(self):
         return self.splunk.get_passwords()
 
+    def get_credentials(self):
+        # {sha1 of the server id: auth token} for every SOAR server, from one paginated request
+        return self.splunk.load_passwords()
+
     def delete_password(self, pw_id):
         self.splunk.delete_password(pw_id)
     
@@ -138,9 +281,75 @@ class PhantomConfig(DictMixin):
         return self.splunk.get_fips_mode()
 
     def get_cim_mapping(self):
-        return json.loads(open(CIM_MAPPING_JSON).read())
+        # shared with every caller in the process, do not modify
+        return load_cim_mapping()
+
+    def get_cim_index(self):
+        if self._cim_index is None:
+            self._cim_index = get_cim_index(self._config.get(FIELD_MAPPING))
+        return self._cim_index
+
+    @classmethod
+    def for_search(cls, component_name, session, search_name):
+        """A config holding the forwarding config of `search_name` and the
+        stanzas it reads. Falls back to the whole config when the search is
+        not in the index of a previous full load.
+        """
+        stanza = (read_json(search_index_file()) or {}).get(search_name)
+        if stanza:
+            config = cls(component_name, session, FORWARDING_SETTINGS + (stanza,))
+            if config.get_forwarding_config(search_name) is not None:
+                return config
+            component_name = config.logger
+        config = cls(component_name, session)
+        save_search_index(config._config)
+        return config
+
+    def _get_config(self, stanzas=None):
+        stamp = conf_stamp()
+        snapshot = read_json(config_snapshot_file()) or {}
+        fresh = snapshot.get('stamp') == stamp and 0 <= time.time() - snapshot.get('saved', 0) < CONFIG_SNAPSHOT_TTL
+        j = None
+        if stanzas is not None:
+            if fresh:
+                j = dict((k, v) for k, v in snapshot['config'].items() if k in stanzas)
+            else:
+                j = self._load_stanzas(stanzas)
+            if any(name not in j for name in stanzas):
+                # a stanza was removed, or splunkd did not filter by name: load everything
+                j = None
+            else:
+                servers = j.get(PHANTOM_KEY, {})
+        if j is None:
+            if fresh:
+                j = snapshot['config']
+            else:
+                j = self._load_config()
+                if j:
+                    write_json(config_snapshot_file(), {'stamp': stamp, 'saved': time.time(), 'config': j})
+                    save_search_index(j)
+            servers = j[PHANTOM_KEY]
+        self._wrap_servers(servers)
+        return j
 
-    def _get_config(self):
+    def _wrap_servers(self, servers):
+        for k, v in servers.items():
+            servers[k] = ServerConfig(v, partial(self.splunk.load_auth_token, k))
+        return servers
+
+    def _load_stanzas(self, stanzas):
+        # One request for all of them. This relies on splunkd applying the
+        # 'search' filter with OR to the entry names, which its REST API does
+        # not document for conf endpoints; _get_config falls back to a full
+        # load when a stanza is missing from the result.
+        query = ' OR '.join('name={}'.format(json.dumps(name)) for name in stanzas)
+        success, content = self.splunk.get(CONFIG_ENDPOINT, params={'count': -1, 'search': query})
+        config = {}
+        if success and content:
+            config = decode_stanzas(entry for entry in content.get('entry', []) if entry.get('name') in stanzas)
+        return config
+
+    def _load_config(self):
         j = self._load_from_rest()
         if not j.get(PHANTOM_KEY) and len(j) <= len(TOP_LEVEL_SETTINGS):
             # no phantom configs and no output configs
@@ -155,9 +364,6 @@ class PhantomConfig(DictMixin):
             j = {}
         # commented out line below temporarily because of unicode .get() error
         # self._do_migrations(j)
-        for k, v in j[PHANTOM_KEY].items():
-            v[TOKEN_KEY] = self.splunk.load_auth_token(k)
-
         return j
 
     def _do_migrations(self, config):
@@ -221,11 +427,7 @@ class PhantomConfig(DictMixin):
         success, content = self.splunk.get(CONFIG_ENDPOINT, params={"count": -1})
         config = {}
         if success and content:
-            for entry in content.get('entry', []):
-                val = entry.get('content', {}).get('value')
-                if val and entry.get('name') != 'enable_logging':
-                    val = json.loads(val)
-                config[entry.get('name', '')] = val
+            config = decode_stanzas(content.get('entry', []))
         if '' in config:
             config.pop('')
         if 'config' in config:
@@ -238,17 +440,83 @@ class PhantomConfig(DictMixin):
         for k, v in j.items():
             if k == VERSION_KEY:
                 v = self.get_version()
-            args = {
-                'name': k,
-            }
+            self._post_setting(k, v)
+        invalidate_config_snapshot()
+
+    def _post_setting(self, key, value, exists=True):
+        # one conf call when `exists` is right, two when it is not
+        args = {
+            'value': json.dumps(value)
+        }
+        calls = [('{}/{}'.format(CONFIG_ENDPOINT, key), args), (CONFIG_ENDPOINT, dict(args, name=key))]
+        if not exists:
+            calls.reverse()
+        try:
+            success, content = self.splunk.post(*calls[0])
+            return success
+        except splunkmod.AuthorizationFailed:
+            raise
+        except:
+            pass
+        success, content = self.splunk.post(*calls[1])
+        return success
+
+    @contextmanager
+    def batch(self):
+        """Hold back the settings assigned in the block and write the ones that
+        changed when it ends, one conf call each.
+
+        If the block raises nothing is written. Settings that fail to save
+        get their previous value back and the first error is raised.
+        """
+        if self._stored is not None:
+            yield self
+            return
+        self._stored = dict((k, json.dumps(v, sort_keys=True)) for k, v in self._config.items())
+        self._pending = []
+        try:
+            yield self
+        except BaseException:
+            for key in self._pending:
+                self._restore(key)
+            raise
+        else:
+            self._commit()
+        finally:
+            self._stored = self._pending = None
+
+    def _commit(self):
+        error = None
+        written = False
+        for key in self._pending:
+            value = self._config[key]
+            if self._stored.get(key) == json.dumps(value, sort_keys=True):
+                continue
             try:
-                self.splunk.post(CONFIG_ENDPOINT, args)
-            except:
-                pass # fails if it already exist
-            args = {
-                'value': json.dumps(v)
-            }
-            success, content = self.splunk.post('{}/{}'.format(CONFIG_ENDPOINT, k), args)
+                if not self._post_setting(key, value, key in self._stored):
+                    raise Exception('Could not save {}'.format(key))
+                written = True
+            except Exception as e:
+                self.logger.error('Could not save {}: {}'.format(key, e))
+                self._restore(key)
+                error = error or e
+        if written:
+            invalidate_config_snapshot()
+        if error is not None:
+            raise error
+
+    def _restore(self, key):
+        if key in self._stored:
+            value = json.loads(self._stored[key])
+            self._config[key] = self._wrap_servers(value) if key == PHANTOM_KEY else value
+        else:
+            self._config.pop(key, None)
+        self._changed(key)
+
+    def _changed(self, key):
+        self._searches = None
+        if key == FIELD_MAPPING:
+            self._cim_index = None
 
     def __len__(self):
         return len(self.keys())
@@ -280,6 +548,10 @@ class PhantomConfig(DictMixin):
         succeeded, result = self.splunk.rest('{}/{}'.format(CONFIG_ENDPOINT, key), {}, 'DELETE')
         if succeeded:
             del self._config[key]
+            if self._pending and key in self._pending:
+                self._pending.remove(key)
+            self._changed(key)
+            invalidate_config_snapshot()
 
     def __getitem__(self, key):
         return self._config[key]
@@ -291,16 +563,17 @@ class PhantomConfig(DictMixin):
                     self.splunk.save_auth_token(server, info[TOKEN_KEY])
                     del info[TOKEN_KEY]
 
-        args = {
-            'name': key,
-        }
-        try:
-            self.splunk.post(CONFIG_ENDPOINT, args)
-        except:
-            pass # fails if it already exist
-        success, content = self.splunk.post('{}/{}'.format(CONFIG_ENDPOINT, key), {'value': json.dumps(value) } )
+        if self._pending is not None:
+            self._config[key] = value
+            if key not in self._pending:
+                self._pending.append(key)
+            self._changed(key)
+            return
+        success = self._post_setting(key, value, key in self._config)
         if success:
             self._config[key] = value
+            self._changed(key)
+            invalidate_config_snapshot()
 
     def __contains__(self, value):
         return value in self._config
@@ -319,6 +592,11 @@ class PhantomConfig(DictMixin):
     def get_forwarding_configs(self):
         return [ v for k, v in self.items() if v and k not in TOP_LEVEL_SETTINGS ]
 
+    def get_forwarding_config(self, name):
+        if self._searches is None:
+            self._searches = dict((v.get('_name'), v) for v in self.get_forwarding_configs())
+        return self._searches.get(name)
+
     @classmethod
     def get_logger(cls, component_name):
         logger = logging.getLogger('splunk.phantom.' + component_name)
@@ -330,13 +608,9 @@ class PhantomConfig(DictMixin):
         LOGGING_STANZA_NAME = 'python'
         LOGGING_FILE_NAME = "phantom_{}.log".format(component_name)
         BASE_LOG_PATH = os.path.join('var', 'log', 'splunk')
-        LOGGING_FORMAT = "%(asctime)s %(levelname)-s\t%(module)s:%(lineno)d - %(message)s"
-        splunk_log_handler = logging.handlers.RotatingFileHandler(os.path.join(SPLUNK_HOME, BASE_LOG_PATH, LOGGING_FILE_NAME), mode='a')
-        splunk_log_handler.setFormatter(logging.Formatter(LOGGING_FORMAT))
         logger.propagate = False
-        handlers_exists = any([True for h in logger.handlers if h.baseFilename == component_name])
-        if not handlers_exists:
-            logger.addHandler(splunk_log_handler)
+        # one handler per component, however often this is called in a process
+        component_handler(logger, os.path.join(SPLUNK_HOME, BASE_LOG_PATH, LOGGING_FILE_NAME))
         splunkmod.setupSplunkLogger(logger, DEFAULT_CONFIG_FILE, LOCAL_CONFIG_FILE, LOGGING_STANZA_NAME)
         logger.setLevel(logging.DEBUG)
         return logger
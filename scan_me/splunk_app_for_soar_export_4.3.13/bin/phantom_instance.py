@@ -14,8 +14,10 @@ try:
 except:
     from urllib.parse import quote, unquote, quote_plus
 
-from copy import deepcopy
 import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 if sys.version_info >= (3, 0):
    from io import StringIO
@@ -28,18 +30,39 @@ else:
 script_path = os.path.join(os.environ['SPLUNK_HOME'], 'etc', 'apps', 'phantom', 'bin')
 sys.path.insert(0, script_path)
 import phantom_requests as requests
+from phantom_requests.adapters import HTTPAdapter
+from urllib3.util.ssl_ import create_urllib3_context
 
 try:
     from .phantom_config import PhantomConfig, get_safe, TOKEN_KEY
 except:
     from phantom_config import PhantomConfig, get_safe, TOKEN_KEY
 
+try:
+    from .phantom_limiter import get_limiter
+except:
+    from phantom_limiter import get_limiter
+
+try:
+    from .phantom_breaker import CircuitBreaker
+except:
+    from phantom_breaker import CircuitBreaker
+
+try:
+    from .phantom_state import RUN_DIR, LIB_DIR, state_file, server_key, load_cached, save_cached, remove_state_files, PersistentMap
+except:
+    from phantom_state import RUN_DIR, LIB_DIR, state_file, server_key, load_cached, save_cached, remove_state_files, PersistentMap
+
 PKS = '__pks[]'
 SEVERITY_KEY = '_severity'
 SENSITIVITY_KEY = '_sensitivity'
 NAME_OVERRIDE_KEY = '_container_name'
 NAME_KEY = '_name'
 TAGS_KEY = 'tags'
+# the [pk_str, pk_hash] of a row, memoized in its cef by _get_pk
+FINGERPRINT_KEY = '_fingerprint'
+# cef keys left out of a row's fingerprint: the severity can be replaced by the fallback
+UNHASHED_CEF_KEYS = (SEVERITY_KEY, FINGERPRINT_KEY)
 
 VALID_SEV = ('high', 'low', 'medium')
 VALID_SENS = ('red', 'green', 'amber', 'white')
@@ -49,6 +72,55 @@ DEFAULT_SENS = 'amber'
 CERT_FILE_LOCATION_DEFAULT = os.path.join(os.environ['SPLUNK_HOME'], 'etc', 'apps', 'phantom', 'default', 'cert_bundle.pem')
 CERT_FILE_LOCATION_LOCAL = os.path.join(os.environ['SPLUNK_HOME'], 'etc', 'apps', 'phantom', 'local', 'cert_bundle.pem')
 
+# Optional per-server keys in the [phantom] stanza that size the connection pool
+POOL_CONNECTIONS_KEY = 'pool_connections'
+POOL_MAXSIZE_KEY = 'pool_maxsize'
+DEFAULT_POOL_CONNECTIONS = 2
+DEFAULT_POOL_MAXSIZE = 10
+# Optional per-server keys that bound a single bulk POST /rest/artifact
+ARTIFACT_BATCH_SIZE_KEY = 'artifact_batch_size'
+ARTIFACT_BATCH_BYTES_KEY = 'artifact_batch_bytes'
+DEFAULT_ARTIFACT_BATCH_SIZE = 100
+DEFAULT_ARTIFACT_BATCH_BYTES = 4 * 1024 * 1024
+
+MAX_IN_FLIGHT_KEY = 'max_in_flight'
+DEFAULT_MAX_IN_FLIGHT = 4
+
+MAX_REQUESTS_PER_SECOND_KEY = 'max_requests_per_second'
+# unlimited until the server pushes back
+DEFAULT_MAX_REQUESTS_PER_SECOND = 0
+THROTTLE_RETRIES = 3
+
+VERIFY_CACHE_TTL_KEY = 'verify_cache_ttl'
+DEFAULT_VERIFY_CACHE_TTL = 300
+CATALOG_CACHE_TTL_KEY = 'catalog_cache_ttl'
+DEFAULT_CATALOG_CACHE_TTL = 300
+
+LIST_PAGE_SIZE = 1000
+
+BREAKER_THRESHOLD_KEY = 'breaker_threshold'
+DEFAULT_BREAKER_THRESHOLD = 2
+BREAKER_COOLDOWN_KEY = 'breaker_cooldown'
+DEFAULT_BREAKER_COOLDOWN = 60
+# failures that mean the server could not be reached at all
+CONNECTION_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+# a bulk artifact post rejected with one of these is retried one artifact at a time to find the bad ones
+ARTIFACT_REJECTED_CODES = (400, 404, 422)
+SERVER_CACHES = ('verify', 'catalog')
+
+CONTAINER_LOOKUP_KEY = 'container_lookup'
+CONTAINER_LOOKUP_OPTIMISTIC = 'optimistic'
+CONTAINER_LOOKUP_QUERY = 'query'
+CONTAINER_MAP_TTL_KEY = 'container_map_ttl'
+DEFAULT_CONTAINER_MAP_TTL = 24 * 60 * 60
+CONTAINER_MAP_SIZE = 10000
+
+CONTAINER_MODE_KEY = 'container_mode'
+CONTAINER_MODE_COMBINED = 'combined'
+CONTAINER_MODE_SEPARATE = 'separate'
+
+SERVER_TUNING_KEYS = (POOL_CONNECTIONS_KEY, POOL_MAXSIZE_KEY, ARTIFACT_BATCH_SIZE_KEY, ARTIFACT_BATCH_BYTES_KEY, MAX_IN_FLIGHT_KEY, MAX_REQUESTS_PER_SECOND_KEY, VERIFY_CACHE_TTL_KEY, CATALOG_CACHE_TTL_KEY, CONTAINER_MODE_KEY, CONTAINER_LOOKUP_KEY, CONTAINER_MAP_TTL_KEY, BREAKER_THRESHOLD_KEY, BREAKER_COOLDOWN_KEY)
+
 DEFAULT_CONTAINS = [
         'ip',
         'user name',
@@ -212,6 +284,327 @@ DEFAULT_CEF_METADATA = {
     "transportProtocol": {'contains': []},
 }
 
+_SESSIONS = {}
+_SSL_CONTEXTS = {}
+_SESSION_LOCK = threading.Lock()
+_CATALOGS = {}
+_CATALOG_LOCK = threading.Lock()
+_CONTAINER_MAPS = {}
+
+
+def retryable_status(status_code):
+    # SOAR is throttling or failing, not rejecting what was sent
+    return status_code == 429 or (status_code or 0) >= 500
+
+
+def retryable_result(result):
+    return isinstance(result, dict) and retryable_status(result.get('status_code'))
+
+
+def container_missing(result):
+    # the artifact's container was deleted on SOAR
+    if not isinstance(result, dict):
+        return False
+    if result.get('status_code') == 404:
+        return True
+    message = str(result.get('message') or '').lower()
+    return 'container' in message and ('not found' in message or 'does not exist' in message)
+
+
+def get_int_setting(config_entry, key, default):
+    try:
+        value = int(config_entry.get(key, default))
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+def get_ssl_context(cert_path):
+    # Loading cert_bundle.pem is the expensive part of a TLS handshake setup,
+    # so every connection to every server shares one context per bundle
+    with _SESSION_LOCK:
+        context = _SSL_CONTEXTS.get(cert_path)
+        if context is None:
+            context = create_urllib3_context()
+            context.load_verify_locations(cafile=cert_path)
+            _SSL_CONTEXTS[cert_path] = context
+        return context
+
+
+class CertBundleAdapter(HTTPAdapter):
+    """HTTPAdapter that verifies against a pre-loaded SSL context instead of
+    re-reading the CA bundle for every new connection."""
+
+    def __init__(self, cert_path, **kwargs):
+        self.cert_path = cert_path
+        self.ssl_context = get_ssl_context(cert_path)
+        super(CertBundleAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **pool_kwargs):
+        pool_kwargs['ssl_context'] = self.ssl_context
+        return super(CertBundleAdapter, self).init_poolmanager(*args, **pool_kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs['ssl_context'] = self.ssl_context
+        return super(CertBundleAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super(CertBundleAdapter, self).cert_verify(conn, url, verify, cert)
+        if verify == self.cert_path:
+            # the CAs are already loaded in self.ssl_context
+            conn.ca_certs = None
+
+
+def server_cache_prefix(kind, server):
+    return '{}_{}_'.format(kind, server_key(server))
+
+
+def invalidate_server_cache(server):
+    """Drop the cached verification results and catalog of a SOAR server for every token."""
+    for kind in SERVER_CACHES:
+        remove_state_files(RUN_DIR, server_cache_prefix(kind, server))
+    with _CATALOG_LOCK:
+        for key in [ key for key in _CATALOGS if key[0] == server ]:
+            del _CATALOGS[key]
+
+
+def get_container_map(server, ttl=DEFAULT_CONTAINER_MAP_TTL):
+    """Return the process-wide source_data_identifier to container id map of a SOAR server."""
+    with _CATALOG_LOCK:
+        container_map = _CONTAINER_MAPS.get(server)
+        if container_map is None:
+            path = state_file(LIB_DIR, 'containers_{}.json'.format(server_key(server)))
+            container_map = _CONTAINER_MAPS[server] = PersistentMap(path, CONTAINER_MAP_SIZE, ttl)
+        return container_map
+
+
+def flush_container_maps():
+    with _CATALOG_LOCK:
+        container_maps = list(_CONTAINER_MAPS.values())
+    for container_map in container_maps:
+        container_map.flush()
+
+
+# how ExtractionPlan turns the looked up value into the cef value
+FIELD_VALUE = 0
+FIELD_CONSTANT = 1
+FIELD_SENSITIVITY = 2
+FIELD_CONTAINER_NAME = 3
+
+
+class ExtractionPlan(object):
+    """The field lookups of find_patterns for one forwarding config, resolved
+    once against the columns of the search results.
+
+    Every row whose keys are `columns` (all rows of a results CSV) can then be
+    mapped with apply() without lowercasing keys or building candidate names.
+    """
+    def __init__(self, search, columns):
+        lowered = {}
+        for column in columns:
+            if column:
+                lowered[column.lower()] = column
+        prefixes = search.get('_prefixes', {})
+        search_prefix = get_safe(search, '_search', '') + '.'
+
+        self.fields = []
+        for k, v in search.items():
+            if k.startswith('_') and k not in (SEVERITY_KEY, SENSITIVITY_KEY, NAME_OVERRIDE_KEY, '_time'):
+                continue
+            column = lowered.get(v.lower() if v else '')
+            if column is None and v in prefixes:
+                column = lowered.get((prefixes[v] + '.' + v).lower())
+                if column is None:
+                    column = lowered.get((search_prefix + v).lower())
+            if k == SEVERITY_KEY:
+                self.fields.append((k, None, FIELD_CONSTANT, v))
+            elif k == SENSITIVITY_KEY:
+                if v in VALID_SENS:
+                    self.fields.append((k, None, FIELD_CONSTANT, v))
+                else:
+                    self.fields.append((k, column, FIELD_SENSITIVITY, None))
+            elif k == NAME_OVERRIDE_KEY and v:
+                self.fields.append((k, column, FIELD_CONTAINER_NAME, 'Field "{}" empty or missing'.format(v)))
+            else:
+                self.fields.append((k, column, FIELD_VALUE, None))
+
+    def apply(self, row):
+        cef = {}
+        for k, column, kind, extra in self.fields:
+            value = None if column is None else row[column]
+            if kind == FIELD_CONSTANT:
+                value = extra
+            elif kind == FIELD_SENSITIVITY:
+                if value not in VALID_SENS:
+                    value = DEFAULT_SENS
+            elif kind == FIELD_CONTAINER_NAME:
+                if not value:
+                    value = extra
+            if value is not None:
+                cef[k] = value
+        return cef
+
+
+# cef keys that describe the container rather than the artifact
+CONTAINER_CEF_KEYS = (SEVERITY_KEY, SENSITIVITY_KEY, NAME_OVERRIDE_KEY, FINGERPRINT_KEY)
+# SOARHELP-1232 all cef items should have a data type so that you can see the Contextual Modal in SOAR artifacts
+UNTYPED_CEF = [""]
+
+
+class ArtifactTemplate(object):
+    """The parts of the artifacts of one forwarding config that are the same
+    for every row.
+
+    build() reads the row's cef without copying it and only allocates the
+    artifact itself and its cef, data and cef_types dicts. The values in those
+    dicts are shared with the row, so callers must not mutate them in place.
+    """
+    def __init__(self, search_config):
+        if not search_config.get('_search'):
+            # it's a saved search
+            self.label = get_safe(search_config, '_artifact_label', 'event')
+        else:
+            self.label = get_safe(search_config, '_search', 'event')
+        self.description = '({}) added by Splunk App for SOAR Export'.format(unquote(search_config[NAME_KEY]))
+        self.cef_types = dict((k, v) for k, v in get_safe(search_config, '_cef_types', {}).items() if v != [None])
+
+    def build(self, cef, data, pk_hash):
+        cleaned = dict([ (k, v) for k, v in data.items() if '.' not in k and not k.startswith('$') ])
+        artifact_cef = {}
+        cef_types = {}
+        for k, value in cef.items():
+            if k in CONTAINER_CEF_KEYS:
+                continue
+            # catch the cef values that are missing from cef but present in the cleaned data
+            if value is None:
+                value = cleaned.get(k)
+            artifact_cef[k] = value
+            cef_types[k] = UNTYPED_CEF
+        cef_types.update(self.cef_types)
+        return {
+            'data': cleaned,
+            'cef': artifact_cef,
+            'label': self.label,
+            'description': self.description,
+            'name': unquote(cef.get(NAME_OVERRIDE_KEY, 'NAME_MISSING')),
+            'source_data_identifier': pk_hash,
+            'type': 'event',
+            'severity': cef.get(SEVERITY_KEY, DEFAULT_SEV),
+            'cef_types': cef_types,
+        }
+
+
+def canonical_value(value):
+    # multi-value fields compare equal whatever order Splunk returned the values in
+    if isinstance(value, list):
+        return sorted(value, key=str)
+    return value
+
+
+def fingerprint_digest(text, fips):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    if fips:
+        return hashlib.sha256(text).hexdigest()
+    return hashlib.md5(text).hexdigest()
+
+
+class SoarResponse(object):
+    """Wraps the response of a SOAR REST call so its body is decoded and parsed once.
+
+    SOAR answers in UTF-8, so the body is decoded directly instead of letting
+    requests guess the charset. Anything else is read from the wrapped response.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self._text = None
+        self._json = None
+        self._parsed = False
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __repr__(self):
+        return repr(self.response)
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.response.content.decode('utf-8', 'replace')
+        return self._text
+
+    def json(self):
+        if not self._parsed:
+            self._json = json.loads(self.text)
+            self._parsed = True
+        return self._json
+
+    def get(self, key):
+        try:
+            response_json = self.json()
+        except ValueError:
+            return None
+        if isinstance(response_json, dict):
+            return response_json.get(key)
+        return None
+
+    @property
+    def id(self):
+        return self.get('id')
+
+    @property
+    def existing_container_id(self):
+        return self.get('existing_container_id')
+
+    @property
+    def message(self):
+        return self.get('message')
+
+
+class SoarCatalog(object):
+    """Severity and container label names of a SOAR server with case-insensitive lookups.
+
+    labels is None when the server did not return its labels; every label is
+    then treated as known.
+    """
+    def __init__(self, severities, labels=None, loaded=None):
+        self.severities = frozenset(name.lower() for name in severities)
+        self.labels = None if labels is None else frozenset(name.lower() for name in labels)
+        self.loaded = time.time() if loaded is None else loaded
+
+    def has_severity(self, severity):
+        return (severity or '').lower() in self.severities
+
+    def has_label(self, label):
+        return self.labels is None or (label or '').lower() in self.labels
+
+    def json(self):
+        return {
+            'severities': sorted(self.severities),
+            'labels': None if self.labels is None else sorted(self.labels),
+            'loaded': self.loaded,
+        }
+
+
+def get_session(server, verify, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """Return the process-wide keep-alive session for a SOAR server, creating it on first use."""
+    key = (server, verify, pool_connections, pool_maxsize)
+    with _SESSION_LOCK:
+        session = _SESSIONS.get(key)
+        if session is not None:
+            return session
+    session = requests.Session()
+    if isinstance(verify, str):
+        adapter = CertBundleAdapter(verify, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    with _SESSION_LOCK:
+        return _SESSIONS.setdefault(key, session)
+
+
 class PhantomInstance(object):
     def __init__(self, config_entry, logger, verify=False, fips_enabled=False):
         self.logger = logger
@@ -236,6 +629,20 @@ class PhantomInstance(object):
         self._cef_metadata = {}
         self._all_contains = {}
         self._set_proxy()
+        self.pool_connections = get_int_setting(config_entry, POOL_CONNECTIONS_KEY, DEFAULT_POOL_CONNECTIONS)
+        self.pool_maxsize = get_int_setting(config_entry, POOL_MAXSIZE_KEY, DEFAULT_POOL_MAXSIZE)
+        self.max_in_flight = get_int_setting(config_entry, MAX_IN_FLIGHT_KEY, DEFAULT_MAX_IN_FLIGHT)
+        # every concurrent request needs its own keep-alive connection
+        self.session = get_session(self.server, self.verify, self.pool_connections, max(self.pool_maxsize, self.max_in_flight))
+        self.breaker = CircuitBreaker(self.server, get_int_setting(config_entry, BREAKER_THRESHOLD_KEY, DEFAULT_BREAKER_THRESHOLD), get_int_setting(config_entry, BREAKER_COOLDOWN_KEY, DEFAULT_BREAKER_COOLDOWN))
+        self.limiter = get_limiter(self.server, get_int_setting(config_entry, MAX_REQUESTS_PER_SECOND_KEY, DEFAULT_MAX_REQUESTS_PER_SECOND))
+        self.artifact_batch_size = get_int_setting(config_entry, ARTIFACT_BATCH_SIZE_KEY, DEFAULT_ARTIFACT_BATCH_SIZE)
+        self.artifact_batch_bytes = get_int_setting(config_entry, ARTIFACT_BATCH_BYTES_KEY, DEFAULT_ARTIFACT_BATCH_BYTES)
+        self.verify_cache_ttl = get_int_setting(config_entry, VERIFY_CACHE_TTL_KEY, DEFAULT_VERIFY_CACHE_TTL)
+        self.catalog_cache_ttl = get_int_setting(config_entry, CATALOG_CACHE_TTL_KEY, DEFAULT_CATALOG_CACHE_TTL)
+        self.combined_containers = config_entry.get(CONTAINER_MODE_KEY, CONTAINER_MODE_COMBINED) != CONTAINER_MODE_SEPARATE
+        self.optimistic_create = config_entry.get(CONTAINER_LOOKUP_KEY, CONTAINER_LOOKUP_OPTIMISTIC) != CONTAINER_LOOKUP_QUERY
+        self.container_map = get_container_map(self.server, get_int_setting(config_entry, CONTAINER_MAP_TTL_KEY, DEFAULT_CONTAINER_MAP_TTL))
 
     @classmethod
     def fips_enabled(cls):
@@ -252,9 +659,8 @@ class PhantomInstance(object):
         return self._all_contains
 
     def _load_cef_metadata(self):
-        base_uri = "{}/rest/cef_metadata".format(self.server)
         try:
-            response = requests.get(base_uri, headers=self.auth_headers, verify=self.verify, proxies=self.proxy)
+            response = self._request('GET', '/rest/cef_metadata')
             response_json = response.json()
             if response.status_code != 200:
                 raise Exception(response_json.get('message', 'Failed'))
@@ -287,17 +693,58 @@ class PhantomInstance(object):
                 self.proxy = { 'https': original_proxy }
 
     def post(self, uri, payload):
+        return self.post_data(uri, json.dumps(payload))
+
+    def _request(self, method, uri, **kwargs):
         base_uri = '{}{}'.format(self.server, uri)
-        data = json.dumps(payload)
-        response = requests.post(base_uri, data=data, headers=self.auth_headers, verify=self.verify, proxies=self.proxy)
-        return response
+        for attempt in range(THROTTLE_RETRIES + 1):
+            self.limiter.acquire()
+            start = time.time()
+            try:
+                response = self.session.request(method, base_uri, headers=self.auth_headers, verify=self.verify, proxies=self.proxy, **kwargs)
+            except CONNECTION_ERRORS:
+                self._connection_failed()
+                raise
+            self.breaker.record_success()
+            rate = self.limiter.update(response.status_code, time.time() - start, response.headers.get('Retry-After'))
+            if response.status_code != 429:
+                break
+            self.logger.info('SOAR server is throttling requests. Slowing down to {:.1f} requests per second'.format(rate))
+        return SoarResponse(response)
+
+    def post_data(self, uri, data):
+        return self._request('POST', uri, data=data)
 
     def get(self, uri, payload):
-        base_uri = '{}{}'.format(self.server, uri)
-        return requests.get(base_uri, params=payload, headers=self.auth_headers, verify=self.verify, proxies=self.proxy)
+        return self._request('GET', uri, params=payload)
 
     @classmethod
     def _get_pk(cls, cef, search_config, fips):
+        """Return the (pk_str, pk_hash) of a row. pk_hash is its source_data_identifier.
+
+        Without primary keys the hash covers the canonical JSON of the cef,
+        leaving out UNHASHED_CEF_KEYS and the container name find_patterns
+        made up from the search name. The result is kept in the cef so the
+        row is only serialized and hashed once.
+        """
+        fingerprint = cef.get(FINGERPRINT_KEY)
+        if fingerprint:
+            return fingerprint[0], fingerprint[1]
+        pk_str = cls._pk_string(cef, search_config)
+        if pk_str is None:
+            pk_str = ''
+            generated_name = cef.get(NAME_OVERRIDE_KEY) == search_config.get(NAME_KEY)
+            canonical = dict((k, canonical_value(v)) for k, v in cef.items()
+                             if k not in UNHASHED_CEF_KEYS and not (generated_name and k == NAME_OVERRIDE_KEY))
+            pk_hash = fingerprint_digest(json.dumps(canonical, sort_keys=True, separators=(',', ':')), fips)
+        else:
+            pk_hash = fingerprint_digest(pk_str, fips)
+        cef[FINGERPRINT_KEY] = [pk_str, pk_hash]
+        return pk_str, pk_hash
+
+    @classmethod
+    def _pk_string(cls, cef, search_config):
+        # None when the search has no primary keys
         keys = search_config.get(PKS)
         if sys.version_info >= (3,0):
             if isinstance(keys, str):
@@ -306,71 +753,19 @@ class PhantomInstance(object):
             if isinstance(keys, basestring):
                 keys = keys.split(',')
         if not keys:
-            pk_str = ''
-            if fips:
-                try:
-                    pk_hash = hashlib.sha256(json.dumps(cef)).hexdigest()
-                except:
-                    pk_hash = hashlib.sha256(json.dumps(cef).encode()).hexdigest()
-            else:
-                try:
-                    pk_hash = hashlib.md5(json.dumps(cef)).hexdigest()
-                except:
-                    pk_hash = hashlib.md5(json.dumps(cef).encode()).hexdigest()
-        else:
-            pk_str = ', '.join([ '{}:{}'.format(k, ''.join(cef[k])) for k in sorted(keys) if k in cef ] )
-            if sys.version_info >= (3,0):
-                if fips:
-                    pk_hash = hashlib.sha256(pk_str.encode()).hexdigest()
-                else:
-                    pk_hash = hashlib.md5(pk_str.encode()).hexdigest()
-            else:
-                if fips:
-                    pk_hash = hashlib.sha256(pk_str).hexdigest()
-                else:
-                    pk_hash = hashlib.md5(pk_str).hexdigest()
-        return pk_str, pk_hash
+            return None
+        return ', '.join([ '{}:{}'.format(k, ''.join(canonical_value(cef[k]))) for k in sorted(keys) if k in cef ] )
 
     @classmethod
-    def find_patterns(cls, search_results, search):
-        cef = {}
-        prefixes = search.get('_prefixes', {})
-        search_prefix = get_safe(search, '_search', '') + '.'
-
-        search_results = dict([ (k.lower(), v) for k, v in search_results.items() if k ])
-        for k, v in search.items():
-            if k.startswith('_') and k not in (SEVERITY_KEY, SENSITIVITY_KEY, NAME_OVERRIDE_KEY, '_time'):
-                continue
-            value = None
-            vl = v.lower() if v else ''
-            if vl in search_results:
-                value = search_results[vl]
-            else:
-                if v in prefixes:
-                    prefix = prefixes[v]
-                    name = (prefix + '.' + v).lower()
-                    if name in search_results:
-                        value = search_results[name]
-                    else:
-                        name = (search_prefix + v).lower()
-                        if name in search_results:
-                            value = search_results[name]
-            if k == SEVERITY_KEY:
-                value = v
-            elif k == SENSITIVITY_KEY:
-                if v in VALID_SENS:
-                    value = v
-                elif value not in VALID_SENS:
-                    value = DEFAULT_SENS
-            elif k == NAME_OVERRIDE_KEY and v:
-                if not value:
-                    value = 'Field "{}" empty or missing'.format(v)
-            if value is not None:
-                cef[k] = value
+    def find_patterns(cls, search_results, search, plan=None):
+        # plan must have been compiled from search and the keys of search_results
+        if plan is None:
+            plan = ExtractionPlan(search, search_results)
+        cef = plan.apply(search_results)
 
-        fips = cls.fips_enabled
         if NAME_OVERRIDE_KEY not in cef:
-            pk_str, pk_hash = cls._get_pk(cef, search, fips)
+            # only the pk string is needed; the row is fingerprinted once it is complete
+            pk_str = cls._pk_string(cef, search)
             if pk_str:
                 pk_str = '{}: {}'.format(search[NAME_KEY], pk_str)
             else:
@@ -378,65 +773,63 @@ class PhantomInstance(object):
             cef[NAME_OVERRIDE_KEY] = pk_str
         return cef
 
-    def create_artifacts(self, cef, data, search_config):
-        artifacts = []
-        cur_cef = deepcopy(cef)
-        artifact = {}
-        fips = self.fips_enabled
-        pk_str, pk_hash = self._get_pk(cef, search_config, fips)
-        severity = cur_cef.pop(SEVERITY_KEY, DEFAULT_SEV)
-        sens = cur_cef.pop(SENSITIVITY_KEY, DEFAULT_SENS)
-        name = cur_cef.pop(NAME_OVERRIDE_KEY, 'NAME_MISSING')
-        cleaned = dict([ (k, v) for k, v in data.items() if '.' not in k and not k.startswith('$') ])
+    def create_artifacts(self, cef, data, search_config, template=None):
+        # template must have been compiled from search_config
+        if template is None:
+            template = ArtifactTemplate(search_config)
+        pk_str, pk_hash = self._get_pk(cef, search_config, self.fips_enabled)
+        return [template.build(cef, data, pk_hash)]
 
-        cef_types = dict() # SOARHELP-1232 all cef items should have a data type so that you can see the Contextual Modal in SOAR artifacts
-        cef_catch = dict() # catch the cef values that are not present in cur_cef, but present in cleaned data
-        for c in cur_cef.keys():
-            cef_types[c] = [""]
-            cef_catch[c] = cur_cef.get(c)
-            if cleaned.get(c) is not None and cef_catch.get(c) is None:
-                cef_catch[c] = cleaned.get(c)
-
-        cef_types_update = get_safe(search_config, '_cef_types', {})
-        for key, value in cef_types_update.items():
-            if value != [None]:
-                cef_types[key] = value
-
-        artifact['data'] = cleaned
-        artifact['cef'] = cef_catch
-        dm = get_safe(search_config, '_search', None)
-        if dm is None:
-            # it's a saved search
-            artifact['label'] = get_safe(search_config, '_artifact_label', 'event')
-        else:
-            artifact['label'] = get_safe(search_config, '_search', 'event')
-        artifact['description'] = '({}) added by Splunk App for SOAR Export'.format(unquote(search_config[NAME_KEY]))
-        artifact['name'] = unquote(name)
-        artifact['source_data_identifier'] = pk_hash
-        artifact['type'] = 'event'
-        artifact['severity'] = severity
-        artifact['cef_types'] = cef_types
-        artifacts.append(artifact)
-        return artifacts
-
-    def get_or_create_container(self, artifact, cef, search_config):
+    def embeds_artifacts(self, artifacts):
+        # Only embed the artifacts when they fit in a single bulk artifact request,
+        # by count and by size
+        if not artifacts or not self.combined_containers or len(artifacts) > self.artifact_batch_size:
+            return False
+        return len(json.dumps(artifacts)) <= self.artifact_batch_bytes
+
+    def _container_payload(self, container, artifacts):
+        if not self.embeds_artifacts(artifacts):
+            return container
+        payload = dict(container)
+        payload['artifacts'] = [ dict((k, v) for k, v in artifact.items() if k != 'container_id') for artifact in artifacts ]
+        return payload
+
+    def create_container_with_artifacts(self, container, artifacts):
+        """Create a container with its artifacts embedded in the same request.
+
+        Returns the JSON response from SOAR. The artifacts were only created when
+        the response has an 'id'; on 'existing_container_id' they still need posting.
+        """
+        response = self.post('/rest/container', self._container_payload(container, artifacts))
+        try:
+            return response.json()
+        except ValueError:
+            return {'message': response.text}
+
+    def get_or_create_container(self, artifact, cef, search_config, artifacts=None):
         container = {}
+        sdi = artifact['source_data_identifier']
+        container_id = self.container_map.get(sdi)
+        if container_id is not None:
+            return False, container_id, None
 
-        query = {
-            '_filter_source_data_identifier': repr(artifact['source_data_identifier']),
-            'sort': 'create_time',
-            'order': 'desc',
-            'page_size': 1,
-        }
-        response = self.get('/rest/container', query)
-        if response.status_code != 200:
-            msg = 'Failed to query container on SOAR server. code {} response {!r}'.format(response.status_code, response.text)
-            self.logger.error(msg)
-            raise Exception(msg)
+        if not self.optimistic_create:
+            query = {
+                '_filter_source_data_identifier': repr(sdi),
+                'sort': 'create_time',
+                'order': 'desc',
+                'page_size': 1,
+            }
+            response = self.get('/rest/container', query)
+            if response.status_code != 200:
+                msg = 'Failed to query container on SOAR server. code {} response {!r}'.format(response.status_code, response.text)
+                self.logger.error(msg)
+                raise Exception(msg)
 
-        j = response.json()
-        if j['count'] > 0:
-            return False, j['data'][0]['id'], response
+            j = response.json()
+            if j['count'] > 0:
+                self.container_map.set(sdi, j['data'][0]['id'])
+                return False, j['data'][0]['id'], response
 
         severity = cef.pop(SEVERITY_KEY, DEFAULT_SEV)
         sens = cef.pop(SENSITIVITY_KEY, DEFAULT_SENS)
@@ -450,24 +843,25 @@ class PhantomInstance(object):
         tags = cef.pop(TAGS_KEY, [])
         container['tags'] = tags
 
-        response = self.post('/rest/container', container)
-        message = repr(response.text)
-        try:
-            message = response.json()['message']
-        except:
-            pass
+        response = self.post('/rest/container', self._container_payload(container, artifacts))
+        message = response.message
+        if message is None:
+            message = repr(response.text)
         if response.status_code != 200:
-            try:
-                return False, response.json()['existing_container_id'], response
-            except:
-                pass
+            container_id = response.existing_container_id
+            if container_id is not None:
+                self.container_map.set(sdi, container_id)
+                return False, container_id, response
             msg = 'Failed to create container on SOAR server. code: {} response: {}'.format(response.status_code, message)
             if message == 'Severity matching query does not exist.':
                 return False, None, message
             self.logger.info(msg)
             raise Exception(msg)
 
-        return True, response.json().get('id'), response
+        container_id = response.id
+        if container_id is not None:
+            self.container_map.set(sdi, container_id)
+        return True, container_id, response
 
     def post_artifact(self, artifact):
         response = self.post('/rest/artifact', artifact)
@@ -479,18 +873,126 @@ class PhantomInstance(object):
             msg = 'Failed to create artifact on SOAR server. code {} response {!r}'.format(response.status_code, response.text)
             self.logger.error(msg)
             return False, None, response, None
-        container = response.json().get('container_id')
-        return True, response.json().get('id'), response, container
+        return True, response.id, response, response.get('container_id')
+
+    def forget_container(self, sdi):
+        # the mapped container is gone, so the next get_or_create_container creates a new one
+        self.container_map.discard(sdi)
+
+    def _artifact_batches(self, artifacts):
+        # Each artifact is serialized once; batches are closed on whichever of
+        # the count or byte limit is reached first
+        batch, encoded, size = [], [], 2
+        for index, artifact in enumerate(artifacts):
+            data = json.dumps(artifact)
+            if batch and (len(batch) >= self.artifact_batch_size or size + len(data) + 1 > self.artifact_batch_bytes):
+                yield batch, encoded
+                batch, encoded, size = [], [], 2
+            batch.append(index)
+            encoded.append(data)
+            size += len(data) + 1
+        if batch:
+            yield batch, encoded
+
+    def _artifact_result(self, artifact, result):
+        if result.get('success') and result.get('id') is not None:
+            return True, result['id'], result, result.get('container_id', artifact.get('container_id'))
+        if result.get('existing_artifact_id') is not None:
+            return False, result['existing_artifact_id'], result, artifact.get('container_id')
+        msg = 'Failed to create artifact on SOAR server. response {!r}'.format(result)
+        self.logger.error(msg)
+        return False, None, result, None
+
+    def post_artifacts(self, artifacts):
+        """Post artifacts with as few bulk requests as the batch limits allow.
+
+        Returns one (created, artifact_id, result, container_id) tuple per artifact
+        in input order, where result is the item's JSON result from SOAR.
+        Failed results carry the 'status_code' of the response when SOAR
+        throttled or failed the whole batch, see retryable_result, or when the
+        artifact's container is gone, see container_missing.
+        """
+        results = [None] * len(artifacts)
+        for batch, encoded in self._artifact_batches(artifacts):
+            response = self.post_data('/rest/artifact', '[{}]'.format(','.join(encoded)))
+            try:
+                response_json = response.json()
+            except ValueError:
+                response_json = {'message': response.text}
+            if isinstance(response_json, list) and len(response_json) == len(batch):
+                for index, result in zip(batch, response_json):
+                    results[index] = self._artifact_result(artifacts[index], result)
+                continue
+            if retryable_status(response.status_code):
+                # posting the items one by one would multiply the load on a server that is already struggling
+                self.logger.error('Bulk artifact post failed with code {}. {} artifacts left for retry'.format(response.status_code, len(batch)))
+                if not isinstance(response_json, dict):
+                    response_json = {'message': response_json}
+                result = dict(response_json, status_code=response.status_code)
+                for index in batch:
+                    results[index] = (False, None, result, None)
+                continue
+            if len(batch) > 1 and response.status_code in ARTIFACT_REJECTED_CODES:
+                # the batch was rejected as a whole, so find the bad items one at a time
+                self.logger.info('Bulk artifact post failed with code {}. Posting {} artifacts individually'.format(response.status_code, len(batch)))
+                for index in batch:
+                    created, artifact_id, item_response, container = self.post_artifact(artifacts[index])
+                    try:
+                        result = item_response.json()
+                    except ValueError:
+                        result = {'message': item_response.text}
+                    if artifact_id is None and isinstance(result, dict):
+                        result = dict(result, status_code=item_response.status_code)
+                    results[index] = (created, artifact_id, result, container)
+                continue
+            if not isinstance(response_json, dict):
+                response_json = {'message': response_json}
+            if response.status_code != 200:
+                response_json = dict(response_json, status_code=response.status_code)
+            for index in batch:
+                results[index] = self._artifact_result(artifacts[index], response_json)
+        return results
+
+    def _connection_failed(self):
+        # make the next run verify the server again
+        invalidate_server_cache(self.server)
+        if self.breaker.record_failure():
+            self.logger.error('SOAR server {} is unreachable. Requests to it are skipped for {} seconds'.format(self.server, self.breaker.cooldown))
 
-    def verify_server(self):
-        base_uri = "{}/rest/ph_user?include_automation=true&_filter_token__key='{}'".format(self.server, quote(self.token))
-        auth_headers = {'ph-auth-token': self.token }
+    def _cache_path(self, kind):
+        return state_file(RUN_DIR, '{}{}.json'.format(server_cache_prefix(kind, self.server), server_key(self.token)))
+
+    def _set_user(self, name):
+        if self.custom_name == '':
+            self.custom_name = '{} ({})'.format(name, self.server)
+        self.user = name
+
+    def _token_request(self, uri):
+        # the token is in the query string, so it is kept out of connection errors
         try:
-            response = requests.get(base_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
-        except requests.exceptions.ConnectionError as e:
+            return self._request('GET', uri, timeout=15)
+        except CONNECTION_ERRORS as e:
             url_encoded_token = self.token.replace('=', '%3D').replace('+', '%2B').replace('&', '%26')
-            message = str(e).replace(url_encoded_token, "<token>")
-            raise Exception(message)
+            raise Exception(str(e).replace(url_encoded_token, "<token>"))
+
+    def verify_server(self, use_cache=True):
+        """Check the token against the server and load its CEF metadata.
+
+        Successful results are cached on disk for verify_cache_ttl seconds per
+        server and token; use_cache=False always asks the server and refreshes
+        the cache. Raises without any request while the server's circuit breaker
+        is open.
+        """
+        if not self.breaker.allow():
+            raise Exception('SOAR server {} is unreachable. Will try again after {} seconds'.format(self.server, self.breaker.cooldown))
+        cache_path = self._cache_path('verify')
+        cached = load_cached(cache_path, self.verify_cache_ttl) if use_cache else None
+        if cached:
+            self._set_user(cached['user'])
+            self._cef_metadata = cached['cef_metadata']
+            self._all_contains = cached['contains']
+            return self.contains(), self.cef_metadata()
+        response = self._token_request("/rest/ph_user?include_automation=true&_filter_token__key='{}'".format(quote(self.token)))
         try:
             if response.status_code != 200:
                 message = 'Failed'
@@ -504,8 +1006,7 @@ class PhantomInstance(object):
                 raise Exception('Token not found')
             name = response_json['data'][0].get('username')
         except:
-            base_uri = "{}/rest/asset?_filter_token__key='{}'".format(self.server, quote(self.token))
-            response = requests.get(base_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy)
+            response = self._token_request("/rest/asset?_filter_token__key='{}'".format(quote(self.token)))
             if response.status_code != 200:
                 raise
             response_json = response.json()
@@ -513,10 +1014,10 @@ class PhantomInstance(object):
                 raise
             name = response_json['data'][0].get('name')
         
-        if self.custom_name == '':
-            self.custom_name = '{} ({})'.format(name, self.server)
-        self.user = name
-        return self.contains(), self.cef_metadata()
+        self._set_user(name)
+        contains, cef_metadata = self.contains(), self.cef_metadata()
+        save_cached(cache_path, {'user': name, 'contains': contains, 'cef_metadata': cef_metadata})
+        return contains, cef_metadata
   
     def json(self):
         j = {
@@ -531,86 +1032,127 @@ class PhantomInstance(object):
         }
         if self.proxy is not None:
             j['proxy'] = self.proxy
+        for key in SERVER_TUNING_KEYS:
+            if key in self._config:
+                j[key] = self._config[key]
         return j
 
+    def _page(self, uri, page):
+        response = self._request('GET', '{}?pretty&page_size={}&page={}'.format(uri, LIST_PAGE_SIZE, page), timeout=15)
+        if response.status_code != 200:
+            raise Exception('Failed to retrieve page {} of {}: code {}'.format(page, uri, response.status_code))
+        return response.json()['data']
+
+    def _remaining_pages(self, uri, first_page, num_pages):
+        for item in first_page:
+            yield item
+        if num_pages < 2:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.max_in_flight, num_pages - 1)) as pool:
+            pages = [ pool.submit(self._page, uri, page) for page in range(1, num_pages) ]
+            for page in pages:
+                for item in page.result():
+                    yield item
+
+    def list_pages(self, uri):
+        """Fetch every item of a paginated SOAR list endpoint such as /rest/playbook.
+
+        Returns (items, None) where items is an iterator over the records of all
+        pages in order, or ([], message) when the first page cannot be fetched.
+        Pages after the first are downloaded concurrently while items are consumed.
+        """
+        response = self._request('GET', '{}?pretty&page_size={}&page=0'.format(uri, LIST_PAGE_SIZE), timeout=15)
+        if response.status_code != 200:
+            message = 'Failed'
+            try:
+                message = response.json().get('message', message)
+            except:
+                pass
+            return [], message
+        response_json = response.json()
+        return self._remaining_pages(uri, response_json['data'], response_json.get('num_pages') or 0), None
+
     def get_playbooks(self):
-        base_uri = "{}/rest/playbook?pretty&page_size=16".format(self.server)
-        auth_headers = { 'ph-auth-token': self.token }
-        response = requests.get(base_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
+        playbooks, message = self.list_pages('/rest/playbook')
         try:
-            if response.status_code != 200:
-                message = 'Failed'
-                try:
-                    message = response.json().get('message', message)
-                except:
-                    pass
+            if message is not None:
                 return [], message
-            response_json = response.json()
-            pages = response_json.get('num_pages')
             playbook_results = []
-            for page in range(pages):
-                page_uri = "{}&page={}".format(base_uri, page)
-                page_response = requests.get(page_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy)
-                if page_response.status_code != 200:
-                    raise
-                page_json = page_response.json()
-                playbooks = page_json['data']
-                for pb in playbooks:
-                    playbook_results.append("{}/{}".format(pb.get('_pretty_scm'), pb.get('name')))
+            for pb in playbooks:
+                playbook_results.append("{}/{}".format(pb.get('_pretty_scm'), pb.get('name')))
             return playbook_results, None
         except:
             self.logger.error("Error retrieving playbooks for {}".format(self.custom_name))
 
     def get_severities(self):
-        base_uri = "{}/rest/severity?pretty".format(self.server)
-        auth_headers = { 'ph-auth-token': self.token }
-        response = requests.get(base_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
+        severities, message = self.list_pages('/rest/severity')
         try:
-            if response.status_code != 200:
-                message = 'Failed'
-                try:
-                    message = response.json().get('message', message)
-                except:
-                    pass
+            if message is not None:
                 self.logger.debug(message)
                 return [], message
-            response_json = response.json()
-            pages = response_json.get('num_pages')
             severity_results = []
-            for page in range(pages):
-                page_uri = "{}&page={}".format(base_uri, page)
-                page_response = requests.get(page_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy)
-                if page_response.status_code != 200:
-                    raise
-                page_json = page_response.json()
-                severities = page_json['data']
-                for sev in severities:
-                    name = sev.get('name', '')
-                    name_formatted = name[0].upper() + name[1:]
-                    severity_results.append(name_formatted)
+            for sev in severities:
+                name = sev.get('name', '')
+                name_formatted = name[0].upper() + name[1:]
+                severity_results.append(name_formatted)
             self.logger.debug("Severities found: {severity_results}".format(severity_results=severity_results))
             return severity_results, None
         except:
             self.logger.error("Error retrieving severities for {}".format(self.custom_name))
 
+    def get_labels(self):
+        response = self.get('/rest/system_settings/events', None)
+        try:
+            labels = response.json().get('label') if response.status_code == 200 else None
+        except ValueError:
+            labels = None
+        if not isinstance(labels, list):
+            self.logger.debug('Could not retrieve container labels for {}'.format(self.custom_name))
+            return None
+        return labels
+
+    def catalog(self):
+        """Return the severity and label catalog of the server.
+
+        The catalog is shared by every PhantomInstance of the process and cached
+        on disk, so SOAR is asked at most once per catalog_cache_ttl seconds.
+        """
+        key = (self.server, server_key(self.token))
+        with _CATALOG_LOCK:
+            catalog = _CATALOGS.get(key)
+        if catalog is not None and time.time() - catalog.loaded < self.catalog_cache_ttl:
+            return catalog
+        # not under _CATALOG_LOCK: a failing request invalidates the server's caches
+        cache_path = self._cache_path('catalog')
+        cached = load_cached(cache_path, self.catalog_cache_ttl)
+        if cached:
+            catalog = SoarCatalog(cached['severities'], cached['labels'], cached['loaded'])
+        else:
+            severities, error = self.get_severities() or ([], 'Failed')
+            catalog = SoarCatalog(severities, self.get_labels())
+            if error is None:
+                save_cached(cache_path, catalog.json())
+        with _CATALOG_LOCK:
+            _CATALOGS[key] = catalog
+        return catalog
+
     def check_severity(self, severity):
-        severities, error = self.get_severities()
-        severities = [x.lower() for x in severities]
-        if severity.lower() in severities:
-            return True
-        return False
+        return self.catalog().has_severity(severity)
+
+    def check_label(self, label):
+        return self.catalog().has_label(label)
 
     def update_workbook_template_helper(self, uri, method, data=None):
-        auth_headers = { 'ph-auth-token': self.token, 'Connection': 'close' }
+        auth_headers = { 'ph-auth-token': self.token }
         if method == 'GET':
-            response = requests.get(uri, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
+            response = self.session.get(uri, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
         elif method == 'POST':
-            response = requests.post(uri, json=data, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
+            response = self.session.post(uri, json=data, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
         elif method == 'DELETE':
             delete_data = {}
             if data:
                 delete_data = data
-            response = requests.delete(uri, json=delete_data, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
+            response = self.session.delete(uri, json=delete_data, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
         try:
             if response.status_code != 200:
                 message = 'Failed'
@@ -817,79 +1359,47 @@ class PhantomInstance(object):
         return tmp
 
     def get_workbook_template(self, last_sync_keys):
-        base_uri = "{}/rest/workbook_template?pretty&page_size=16".format(self.server)
-        auth_headers = { 'ph-auth-token': self.token, 'Connection': 'close' }
-        response = requests.get(base_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
+        workbook_templates, message = self.list_pages('/rest/workbook_template')
         try:
-            if response.status_code != 200:
-                message = 'Failed'
-                try:
-                    message = response.json().get('message', message)
-                except:
-                    pass
+            if message is not None:
                 return [], message
-            response_json = response.json()
-            pages = response_json.get('num_pages')
             workbook_template_results = {}
-            for page in range(pages):
-                page_uri = "{}&page={}".format(base_uri, page)
-                page_response = requests.get(page_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy)
-                if page_response.status_code != 200:
-                    raise
-                page_json = page_response.json()
-                workbook_templates = page_json['data']
-                for wt in workbook_templates:
-                    if wt.get('status') is not "deleted":
-                        name = wt.get('name')
-                        local_existing_names = set(workbook_template_results.keys())
-                        all_existing_names = local_existing_names.union(last_sync_keys)
-                        if name in local_existing_names:
-                            count = 1
+            for wt in workbook_templates:
+                if wt.get('status') is not "deleted":
+                    name = wt.get('name')
+                    local_existing_names = set(workbook_template_results.keys())
+                    all_existing_names = local_existing_names.union(last_sync_keys)
+                    if name in local_existing_names:
+                        count = 1
+                        new_name = "{}_{}".format(name, count)
+                        while new_name in all_existing_names:
+                            count += 1
                             new_name = "{}_{}".format(name, count)
-                            while new_name in all_existing_names:
-                                count += 1
-                                new_name = "{}_{}".format(name, count)
-                            workbook_template_results[new_name] = {"_original_name": name, "prev_state": wt.get('status'), "status": "deleted", "name": new_name, "id": wt.get('id'), "description": wt.get('description', ''), "is_default": wt.get("is_default"), "is_note_required": wt.get('is_note_required'), "phases": []}
-                        else:
-                            workbook_template_results[name] = {"_originating_server": [{"ph_auth_config_id": self.ph_auth_config_id, "workbook_template_id": wt.get('id')}], "status": wt.get('status'), "name": name, "id": wt.get('id'), "description": wt.get('description', ''), "is_default": wt.get("is_default"), "is_note_required": wt.get('is_note_required'), "phases": []}
+                        workbook_template_results[new_name] = {"_original_name": name, "prev_state": wt.get('status'), "status": "deleted", "name": new_name, "id": wt.get('id'), "description": wt.get('description', ''), "is_default": wt.get("is_default"), "is_note_required": wt.get('is_note_required'), "phases": []}
+                    else:
+                        workbook_template_results[name] = {"_originating_server": [{"ph_auth_config_id": self.ph_auth_config_id, "workbook_template_id": wt.get('id')}], "status": wt.get('status'), "name": name, "id": wt.get('id'), "description": wt.get('description', ''), "is_default": wt.get("is_default"), "is_note_required": wt.get('is_note_required'), "phases": []}
 
             return workbook_template_results, None
         except Exception as e:
             self.logger.error("Error retrieving workbook templates for {}: Error: {}".format(self.custom_name, e))
 
     def get_workbook_phase_template(self):
-        base_uri = "{}/rest/workbook_phase_template?pretty&page_size=16".format(self.server)
-        auth_headers = { 'ph-auth-token': self.token, 'Connection': 'close' }
-        response = requests.get(base_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy, timeout=15)
+        workbook_templates, message = self.list_pages('/rest/workbook_phase_template')
         try:
-            if response.status_code != 200:
-                message = 'Failed'
-                try:
-                    message = response.json().get('message', message)
-                except:
-                    pass
+            if message is not None:
                 return [], message
-            response_json = response.json()
-            pages = response_json.get('num_pages')
             results = {}
-            for page in range(pages):
-                page_uri = "{}&page={}".format(base_uri, page)
-                page_response = requests.get(page_uri, headers=auth_headers, verify=self.verify, proxies=self.proxy)
-                if page_response.status_code != 200:
-                    raise
-                page_json = page_response.json()
-                workbook_templates = page_json['data']
-                for wt in workbook_templates:
-                    key = str(wt.get('template'))
-                    if results.get(key) is None:
-                        results[key] = []
-                    cleaned_tasks = []
-                    tasks = wt.get('tasks', [])
-                    for t in tasks:
-                        del t['create_time']
-                        del t['modified_time']
-                        cleaned_tasks.append(t)
-                    results[key].append({"name": wt.get('name'), "template": wt.get('template'), "id": wt.get('id'), "order": wt.get("order"), "sla": wt.get('sla'), "sla_type": wt.get('sla_type'), "tasks": cleaned_tasks})
+            for wt in workbook_templates:
+                key = str(wt.get('template'))
+                if results.get(key) is None:
+                    results[key] = []
+                cleaned_tasks = []
+                tasks = wt.get('tasks', [])
+                for t in tasks:
+                    del t['create_time']
+                    del t['modified_time']
+                    cleaned_tasks.append(t)
+                results[key].append({"name": wt.get('name'), "template": wt.get('template'), "id": wt.get('id'), "order": wt.get("order"), "sla": wt.get('sla'), "sla_type": wt.get('sla_type'), "tasks": cleaned_tasks})
             return results, None
         except:
             self.logger.error("Error retrieving workbook templates for {}".format(self.custom_name))
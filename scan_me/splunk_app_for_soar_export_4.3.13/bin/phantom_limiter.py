@@ -0,0 +1,143 @@
+# File: phantom_limiter.py
+# Copyright (c) 2016-2024 Splunk Inc.
+#
+# SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
+# without a valid written license from Splunk Inc. is PROHIBITED.
+
+import time
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+    from .phantom_state import RUN_DIR, state_file, server_key, read_json, write_json
+except:
+    from phantom_state import RUN_DIR, state_file, server_key, read_json, write_json
+
+MIN_RATE = 0.5
+MAX_RETRY_AFTER = 60.0
+SLOW_RESPONSE_SECONDS = 5.0
+THROTTLED_CODES = (429, 503)
+# a backoff saved by another process is picked up by limiters created within this many seconds
+BACKOFF_MEMORY = 60.0
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        seconds = mktime_tz(parsed) - time.time()
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class RateLimiter(object):
+    """Token bucket for one SOAR server, shared by the threads of a process.
+
+    Requests are not limited until SOAR pushes back, unless max_rate is set.
+    When SOAR answers 429/503 or responds slowly, the rate is halved from what
+    was being sent. It creeps back up while responses are fast, up to max_rate,
+    or to unlimited again when there is none. Only the backoff is written to
+    disk, so that the other processes sending to the server start from it.
+    """
+    def __init__(self, server, max_rate=0):
+        self.path = state_file(RUN_DIR, 'ratelimit_{}.json'.format(server_key(server)))
+        self.max_rate = float(max_rate) if max_rate > 0 else None
+        # None while unlimited
+        self.rate = self.max_rate
+        # where the rate stops creeping up
+        self.ceiling = self.max_rate
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self.window_start = self.updated
+        self.window_count = 0
+        self.sent_rate = 0.0
+        self._lock = threading.Lock()
+        self._load_backoff()
+
+    def _load_backoff(self):
+        state = read_json(self.path) or {}
+        if time.time() - state.get('saved', 0) < BACKOFF_MEMORY:
+            rate = max(MIN_RATE, float(state.get('rate', MIN_RATE)))
+            self.rate = min(rate, self.max_rate) if self.max_rate else rate
+            self.ceiling = self.max_rate or float(state.get('ceiling', rate))
+            self.blocked_until = float(state.get('blocked_until', 0))
+
+    def _save_backoff(self, now):
+        write_json(self.path, {
+            'rate': self.rate,
+            'ceiling': self.ceiling,
+            'blocked_until': self.blocked_until,
+            'saved': now,
+        })
+
+    def _sent(self, now):
+        self.window_count += 1
+        if now - self.window_start >= 1.0:
+            self.sent_rate = self.window_count / (now - self.window_start)
+            self.window_start = now
+            self.window_count = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        self._sent(now)
+                        return
+                    self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self._sent(now)
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(min(wait, MAX_RETRY_AFTER))
+
+    def _slow_down(self, now):
+        current = self.rate
+        if current is None:
+            # requests sent over the last second or so
+            current = max(self.sent_rate, self.window_count / max(now - self.window_start, 1.0), 2 * MIN_RATE)
+            self.ceiling = current
+        self.rate = max(MIN_RATE, current / 2)
+        self.tokens = 0.0
+        self.updated = now
+
+    def update(self, status_code, elapsed, retry_after=None):
+        with self._lock:
+            now = time.time()
+            if status_code in THROTTLED_CODES:
+                self._slow_down(now)
+                delay = parse_retry_after(retry_after)
+                if delay is None:
+                    delay = 1.0 / self.rate
+                self.blocked_until = max(self.blocked_until, now + delay)
+                self._save_backoff(now)
+            elif elapsed > SLOW_RESPONSE_SECONDS:
+                self._slow_down(now)
+                self._save_backoff(now)
+            elif self.rate is not None and self.rate < self.ceiling:
+                self.rate = min(self.ceiling, self.rate + MIN_RATE)
+                if self.rate >= self.ceiling and self.max_rate is None:
+                    self.rate = None
+            return self.rate
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(server, max_rate=0):
+    """Return the process-wide RateLimiter of a SOAR server."""
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get((server, max_rate))
+        if limiter is None:
+            limiter = _LIMITERS[(server, max_rate)] = RateLimiter(server, max_rate)
+        return limiter
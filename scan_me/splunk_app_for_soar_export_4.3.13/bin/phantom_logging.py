@@ -0,0 +1,95 @@
+# File: phantom_logging.py
+# Copyright (c) 2016-2024 Splunk Inc.
+#
+# SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
+# without a valid written license from Splunk Inc. is PROHIBITED.
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+LOGGING_FORMAT = "%(asctime)s %(levelname)-s\t%(module)s:%(lineno)d - %(message)s"
+
+# per-row messages: how many are logged before sampling starts, then one every this many seconds
+SAMPLE_BURST = 10
+SAMPLE_INTERVAL = 10
+
+
+class QueuedFileHandler(logging.handlers.QueueHandler):
+    """Hands records to a thread that writes them to a rotating log file, so
+    logging does not wait on the disk.
+
+    A process forked after the handler was created writes directly, as the
+    writer thread stayed in the parent.
+    """
+    def __init__(self, log_file):
+        self.file_handler = logging.handlers.RotatingFileHandler(log_file, mode='a')
+        self.file_handler.setFormatter(logging.Formatter(LOGGING_FORMAT))
+        self.baseFilename = self.file_handler.baseFilename
+        super(QueuedFileHandler, self).__init__(queue.Queue(-1))
+        self.pid = os.getpid()
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        if os.getpid() == self.pid:
+            super(QueuedFileHandler, self).emit(record)
+        else:
+            self.file_handler.handle(record)
+
+    def close(self):
+        # writes out what is still queued
+        if self.listener is not None and os.getpid() == self.pid:
+            listener, self.listener = self.listener, None
+            listener.stop()
+            self.file_handler.close()
+        super(QueuedFileHandler, self).close()
+
+
+def component_handler(logger, log_file):
+    """Add a QueuedFileHandler for `log_file` to `logger` unless it already has one."""
+    log_file = os.path.abspath(log_file)
+    for h in logger.handlers:
+        if getattr(h, 'baseFilename', None) == log_file:
+            return h
+    handler = QueuedFileHandler(log_file)
+    logger.addHandler(handler)
+    return handler
+
+
+class LogSampler(object):
+    """Logs the first few messages of a per-row loop and then at most one
+    every `interval` seconds, with a count of the ones skipped in between.
+
+    Pass the values as arguments so they are only formatted when logged.
+    """
+    def __init__(self, logger, level=logging.DEBUG, burst=SAMPLE_BURST, interval=SAMPLE_INTERVAL):
+        self.logger = logger
+        self.level = level
+        self.burst = burst
+        self.interval = interval
+        self.logged = 0
+        self.skipped = 0
+        self.last = 0
+
+    def __call__(self, msg, *args):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        now = time.time()
+        if self.logged >= self.burst and now - self.last < self.interval:
+            self.skipped += 1
+            return
+        if self.skipped:
+            msg += ' ({} similar messages skipped)'.format(self.skipped)
+        self.logged += 1
+        self.skipped = 0
+        self.last = now
+        if sys.version_info >= (3, 8):
+            self.logger.log(self.level, msg, *args, stacklevel=2)
+        else:
+            self.logger.log(self.level, msg, *args)
@@ -0,0 +1,71 @@
+# File: phantom_mapping.py
+# Copyright (c) 2016-2024 Splunk Inc.
+#
+# SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
+# without a valid written license from Splunk Inc. is PROHIBITED.
+
+import os
+import json
+import hashlib
+import threading
+
+CIM_MAPPING_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cim_cef.json')
+
+_CIM_MAPPINGS = {}
+_CIM_INDEXES = {}
+_LOCK = threading.Lock()
+
+
+def load_cim_mapping(path=CIM_MAPPING_JSON):
+    """Return the parsed cim_cef.json, read once per process and file version.
+
+    The returned dict is shared; callers must not modify it.
+    """
+    mtime = os.path.getmtime(path)
+    with _LOCK:
+        cached = _CIM_MAPPINGS.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path) as f:
+                cached = _CIM_MAPPINGS[path] = (mtime, json.load(f))
+        return cached[1]
+
+
+class CimCefIndex(object):
+    """CIM field name to CEF field name lookups.
+
+    Built from cim_cef.json, where a null CEF name means the CIM name is used
+    as is, with the custom field_mapping entries ({'cim': ..., 'cef': ...})
+    layered on top. `cef` maps every known CIM field to its CEF name and
+    `reverse` maps a CEF name to the tuple of CIM fields that produce it.
+    """
+    def __init__(self, cim_mapping, field_mapping=None):
+        self.mapping = dict(cim_mapping)
+        for entry in (field_mapping or {}).values():
+            if isinstance(entry, dict) and entry.get('cim') and entry.get('cef'):
+                self.mapping[entry['cim']] = entry['cef']
+        self.cef = dict((cim, cef or cim) for cim, cef in self.mapping.items())
+        reverse = {}
+        for cim, cef in self.cef.items():
+            reverse.setdefault(cef, []).append(cim)
+        self.reverse = dict((cef, tuple(sorted(cims))) for cef, cims in reverse.items())
+
+    def __contains__(self, cim_field):
+        return cim_field in self.cef
+
+    def cef_name(self, cim_field, default=None):
+        return self.cef.get(cim_field, default)
+
+    def cim_names(self, cef_field):
+        return self.reverse.get(cef_field, ())
+
+
+def get_cim_index(field_mapping=None, path=CIM_MAPPING_JSON):
+    """Return the CimCefIndex for cim_cef.json and field_mapping, built once per version of both."""
+    cim_mapping = load_cim_mapping(path)
+    version = (path, os.path.getmtime(path), hashlib.sha256(json.dumps(field_mapping or {}, sort_keys=True).encode('utf-8')).hexdigest())
+    with _LOCK:
+        index = _CIM_INDEXES.get(version)
+        if index is None:
+            _CIM_INDEXES.clear()
+            index = _CIM_INDEXES[version] = CimCefIndex(cim_mapping, field_mapping)
+        return index
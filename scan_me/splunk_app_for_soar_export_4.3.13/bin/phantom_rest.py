@@ -31,12 +31,12 @@ sys.path.insert(0, os.path.join(APP_HOME_DIR, 'bin'))
 
 try:
     from .phantom_config import PhantomConfig, PHANTOM_KEY, PHANTOM_AR_KEY, SEVERITIES, SEVERITIES_AR, PLAYBOOKS, PLAYBOOKS_AR, LOGGING_CONFIG, ACCEPTED, get_safe, VERIFY_KEY, FIELD_MAPPING, ARTIFACT_AR, WORKBOOK_KEY, WORKBOOK_LAST_SYNC_TIME, WORKBOOK_SYNC_KEY
-    from .phantom_instance import PhantomInstance, DEFAULT_CEF_METADATA, DEFAULT_CONTAINS
+    from .phantom_instance import PhantomInstance, ExtractionPlan, DEFAULT_CEF_METADATA, DEFAULT_CONTAINS, invalidate_server_cache, flush_container_maps, FINGERPRINT_KEY
     from .phantom_splunk import SERVER_INFO_ENDPOINT, PasswordStoreException
     from .phantom_imports import DEFAULT_SEVERITIES
 except:
     from phantom_config import PhantomConfig, PHANTOM_KEY, PHANTOM_AR_KEY, SEVERITIES, SEVERITIES_AR, PLAYBOOKS, PLAYBOOKS_AR, LOGGING_CONFIG, ACCEPTED, get_safe, VERIFY_KEY, FIELD_MAPPING, ARTIFACT_AR, WORKBOOK_KEY, WORKBOOK_LAST_SYNC_TIME, WORKBOOK_SYNC_KEY
-    from phantom_instance import PhantomInstance, DEFAULT_CEF_METADATA, DEFAULT_CONTAINS
+    from phantom_instance import PhantomInstance, ExtractionPlan, DEFAULT_CEF_METADATA, DEFAULT_CONTAINS, invalidate_server_cache, flush_container_maps, FINGERPRINT_KEY
     from phantom_splunk import SERVER_INFO_ENDPOINT, PasswordStoreException
     from phantom_imports import DEFAULT_SEVERITIES
 
@@ -221,6 +221,11 @@ class UpdatePhantomConfig(BaseRestHandler):
 
             new_server_configs = {}
             servers = []
+            if do_save is True:
+                # cached verification results may belong to a changed or removed token
+                for cur_config in list(saved_config.get(PHANTOM_KEY, {}).values()) + list(server_configs):
+                    if cur_config.get('server'):
+                        invalidate_server_cache(cur_config['server'])
             for cur_config in server_configs:
                 tmp_cur_config = cur_config
                 saved_config.logger.debug("Checking '{}'".format(tmp_cur_config.get('custom_name')))
@@ -238,7 +243,7 @@ class UpdatePhantomConfig(BaseRestHandler):
                     pi = PhantomInstance(
                         tmp_cur_config, saved_config.logger, verify=saved_config[VERIFY_KEY], fips_enabled=saved_config.fips_is_enabled)
                     if tmp_cur_config.get('validate') is True:
-                        contains, cef_metadata = pi.verify_server()
+                        contains, cef_metadata = pi.verify_server(use_cache=False)
                     else:
                         new_server_configs[tmp_cur_config.get(
                             'ph_auth_config_id')] = tmp_cur_config
@@ -283,9 +288,10 @@ class UpdatePhantomConfig(BaseRestHandler):
             if do_save is True:
                 saved_config.logger.info("Saving configurations...")
                 try:
-                    saved_config[PHANTOM_KEY] = new_server_configs
-                    saved_config[ACCEPTED] = self.request['form'].get(
-                        ACCEPTED) == 'true' and True or False
+                    with saved_config.batch():
+                        saved_config[PHANTOM_KEY] = new_server_configs
+                        saved_config[ACCEPTED] = self.request['form'].get(
+                            ACCEPTED) == 'true' and True or False
                 except splunk.AuthorizationFailed as e:
                     raise Exception(SERVER_PERMISSIONS_ERROR)
                 try:
@@ -306,17 +312,11 @@ class UpdatePhantomConfig(BaseRestHandler):
                 except:
                     pass
                 try:
-                    saved_config.logger.info("Cleaning severities...")
-                    current_severities = saved_config[SEVERITIES]
-                    new_server_severities = {key: value for key, value in current_severities.items() if key in servers}
-                    saved_config[SEVERITIES] = new_server_severities
-                except:
-                    pass
-                try:
-                    saved_config.logger.info("Cleaning playbooks...")
-                    current_playbooks = saved_config[PLAYBOOKS]
-                    new_server_playbooks = {key: value for key, value in current_playbooks.items() if key in servers}
-                    saved_config[PLAYBOOKS] = new_server_playbooks
+                    saved_config.logger.info("Cleaning severities and playbooks...")
+                    with saved_config.batch():
+                        for setting in (SEVERITIES, PLAYBOOKS):
+                            if setting in saved_config:
+                                saved_config[setting] = {key: value for key, value in saved_config[setting].items() if key in servers}
                 except:
                     pass
                 # AR Relay: post the configs to KVStore
@@ -456,8 +456,9 @@ class TargetPlaybook(BaseRestHandler):
 
             updated_playbooks = self.updatePlaybooks(config, playbooks, live_servers)
             try:
-                config[PLAYBOOKS] = updated_playbooks
-                config[ACCEPTED] = self.request['form'].get(ACCEPTED) == 'true' and True or False
+                with config.batch():
+                    config[PLAYBOOKS] = updated_playbooks
+                    config[ACCEPTED] = self.request['form'].get(ACCEPTED) == 'true' and True or False
                 config.logger.debug("Playbooks updated")
             except splunk.AuthorizationFailed as e:
                 raise Exception(SERVER_PERMISSIONS_ERROR)
@@ -711,9 +712,10 @@ class TargetSeverity(BaseRestHandler):
 
             updated_severities = self.updateSeverities(config, severities, live_servers)
             try:
-                config[SEVERITIES] = updated_severities
-                config[ACCEPTED] = self.request['form'].get(
-                    ACCEPTED) == 'true' and True or False
+                with config.batch():
+                    config[SEVERITIES] = updated_severities
+                    config[ACCEPTED] = self.request['form'].get(
+                        ACCEPTED) == 'true' and True or False
             except splunk.AuthorizationFailed as e:
                 raise Exception(SERVER_PERMISSIONS_ERROR)
             status = 200 if len(errors) == 0 else 400
@@ -995,12 +997,18 @@ class PreviewSearch(BaseRestHandler):
                 raise Exception(content)
             response = {'success': True}
             response['results'] = results = []
+            # unlike a results CSV, each JSON result only has its non-empty fields
+            plans = {}
             for j_str in content.splitlines():
                 j = json.loads(j_str)
                 res = j.get('result', {})
                 if not res:
                     continue
-                cef = PhantomInstance.find_patterns(res, search)
+                columns = frozenset(res)
+                plan = plans.get(columns)
+                if plan is None:
+                    plan = plans[columns] = ExtractionPlan(search, res)
+                cef = PhantomInstance.find_patterns(res, search, plan)
                 result = {
                     '_raw': res.get('_raw', ''),
                     '_meta': search,
@@ -1119,9 +1127,10 @@ class SearchForRelays(BaseRestHandler):
             msg = "No severities results returned from search"
             config.logger.error(msg)
         try:
-            config[PHANTOM_AR_KEY] = phantom_ar
-            config[PLAYBOOKS_AR] = playbook_ar
-            config[SEVERITIES_AR] = severities_ar
+            with config.batch():
+                config[PHANTOM_AR_KEY] = phantom_ar
+                config[PLAYBOOKS_AR] = playbook_ar
+                config[SEVERITIES_AR] = severities_ar
         except Exception as e:
             config.logger.debug("Error posting phantom_ar data: {}".format(e))
             raise Exception(e)
@@ -1161,6 +1170,10 @@ class PushData(BaseRestHandler):
                 target['arrelay'] = False
             pi = PhantomInstance(target, config.logger,
                                  verify=config[VERIFY_KEY], fips_enabled=config.fips_is_enabled)
+            # the previewed fields may have been edited, so the row is fingerprinted
+            # as forward_csv maps it and gets the same source_data_identifier
+            mapped = PhantomInstance.find_patterns(dict(raw), search)
+            cef[FINGERPRINT_KEY] = list(PhantomInstance._get_pk(mapped, search, pi.fips_enabled))
             artifacts = pi.create_artifacts(cef, raw, search)
             if artifacts:
                 artifact = artifacts[0]
@@ -1169,7 +1182,7 @@ class PushData(BaseRestHandler):
                 if key and value:
                     artifact['cef'][key] = value
                 created, container_id, resp = pi.get_or_create_container(
-                    artifact, cef, search)
+                    artifact, cef, search, artifacts)
                 if container_id is None:
                     config.logger.info('Could not create container. Check that the severity is valid.')
                     return {
@@ -1178,11 +1191,13 @@ class PushData(BaseRestHandler):
                     }
                 else:
                     config.logger.info({'new_container': container_id})
-                for artifact in artifacts:
-                    artifact['container_id'] = container_id
-                    artifact_id = pi.post_artifact(artifact)
-                    config.logger.info({'new artifact': artifact_id})
-                    container_id = artifact_id[3] if artifact_id[3] is not None else container_id
+                if not (created and pi.embeds_artifacts(artifacts)):
+                    for artifact in artifacts:
+                        artifact['container_id'] = container_id
+                    for artifact_id in pi.post_artifacts(artifacts):
+                        config.logger.info({'new artifact': artifact_id})
+                        container_id = artifact_id[3] if artifact_id[3] is not None else container_id
+                flush_container_maps()
             response['success'] = True
             response['message'] = 'Successfully sent entry to SOAR'
             response['container_id'] = container_id
@@ -1440,7 +1455,7 @@ class PhantomWorkbooks(PersistentServerConnectionApplication):
                 server['arrelay'] = False
             server['ph-auth-token'] = unquote(server.get('ph-auth-token'))
             pi = PhantomInstance(server, self.config.logger, verify=self.config[VERIFY_KEY], fips_enabled=self.config.fips_is_enabled)
-            contains, cef_metadata = pi.verify_server()
+            contains, cef_metadata = pi.verify_server(use_cache=False)
             self.config.logger.info("Connection to '{}' is valid".format(server.get('custom_name')))
             return True, None
         except Exception as e:
@@ -35,6 +35,7 @@ ADDON_ENDPOINT = '/services/ta_addonphantom_account'
 CONFIG_ENDPOINT = '/servicesNS/nobody/phantom/configs/conf-phantom'
 APP_NAME = 'phantom'
 OWNER = 'nobody'
+PASSWORD_PAGE_SIZE = 500
 
 class PasswordStoreException(Exception):
     pass
@@ -46,17 +47,40 @@ class Splunk(object):
             self.session = cherrypy.session.get('sessionKey')
         self.hostname = None
         self.logger = logger
+        self._passwords = None
         # self.clear_password_from_store()
 
-    def get_passwords(self):
-        content = {}
+    def load_passwords(self):
+        """Return {username: clear_password} for every password stored by the app.
+
+        Fetched in pages on first use and kept until a password is changed
+        through this object.
+        """
+        if self._passwords is not None:
+            return self._passwords
+        passwords = {}
+        params = {
+            'count': PASSWORD_PAGE_SIZE,
+            'offset': 0,
+            'search': 'eai:acl.app={}'.format(APP_NAME),
+        }
         try:
-            response, content = self.get(PASSWORD_ENDPOINT)
+            while True:
+                success, content = self.get(PASSWORD_ENDPOINT, params=dict(params))
+                entries = content.get('entry', [])
+                for entry in entries:
+                    password = entry.get('content', {})
+                    passwords[password.get('username')] = password.get('clear_password')
+                params['offset'] += len(entries)
+                if not entries or params['offset'] >= content.get('paging', {}).get('total', 0):
+                    break
         except:
             self.logger.error("Could not retrieve passwords from storage")
+        self._passwords = passwords
+        return passwords
 
-        ids = [pass_id['content']['username'] for pass_id in content['entry']] # current passwords
-        return ids
+    def get_passwords(self):
+        return list(self.load_passwords()) # current passwords
 
     def delete_password(self, pw_id):
         path = "{}/%3A{}%3A".format(PASSWORD_ENDPOINT, pw_id)
@@ -69,6 +93,7 @@ class Splunk(object):
                 }
             }
             response, content = splunk.rest.simpleRequest(path, **args)
+            self._passwords = None
             self.logger.info("Delete password '{}': {}".format(pw_id, response.status))
         except Exception as e:
             self.logger.error("Could not delete '{}': {}".format(pw_id, e))
@@ -86,6 +111,7 @@ class Splunk(object):
                 }
             }
             response, content = splunk.rest.simpleRequest(path, **args)
+            self._passwords = None
             self.logger.debug("Posting password ID '{}': {}".format(pw_id, response.status))
         except Exception as e:
             self.logger.error("Could not post '{}': {}".format(pw_id, e))
@@ -198,6 +224,9 @@ class Splunk(object):
             return ''
 
         name = hashlib.sha1(server.encode()).hexdigest()
+        token = self.load_passwords().get(name)
+        if token is not None:
+            return token
 
         try:
             succeeded, result = self.get('{}/{}'.format(PASSWORD_ENDPOINT, name))
@@ -217,6 +246,7 @@ class Splunk(object):
                     'password': token,
                 }
                 self.post(PASSWORD_ENDPOINT, args)
+                self._passwords = None
             except splunk.AuthorizationFailed as e:
                 raise
             except Exception as e:
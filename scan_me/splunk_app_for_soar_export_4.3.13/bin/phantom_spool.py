@@ -0,0 +1,151 @@
+# File: phantom_spool.py
+# Copyright (c) 2016-2024 Splunk Inc.
+#
+# SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
+# without a valid written license from Splunk Inc. is PROHIBITED.
+
+import os
+import shutil
+import threading
+import time
+
+try:
+    from .phantom_state import RUN_DIR, LIB_DIR, state_file, read_json, write_json
+except:
+    from phantom_state import RUN_DIR, LIB_DIR, state_file, read_json, write_json
+
+# Forwarding alerts waiting for the delivery daemon. An entry is a copy of the
+# results file (<id>.csv.gz) plus its metadata (<id>.json), written last.
+SPOOL_DIR = os.path.join(LIB_DIR, 'spool')
+SPOOL_SUFFIX = '.json'
+RESULTS_SUFFIX = '.csv.gz'
+
+# A spooled alert the daemon could not finish is tried again after
+# SPOOL_RETRY_DELAY * 2^(attempts - 1) seconds and dropped after SPOOL_MAX_ATTEMPTS.
+SPOOL_RETRY_DELAY = 60
+SPOOL_MAX_ATTEMPTS = 10
+
+# Retry items the KV Store did not take, one JSON document each, for
+# phantom_retry.py to move into the retry collection.
+RETRY_DIR = os.path.join(LIB_DIR, 'retry')
+
+HEARTBEAT_INTERVAL = 5
+# a daemon that has not written its heartbeat for this long is considered gone
+HEARTBEAT_STALE = 3 * HEARTBEAT_INTERVAL
+
+
+def heartbeat_file():
+    return state_file(RUN_DIR, 'forward_daemon.json')
+
+
+def daemon_alive():
+    beat = read_json(heartbeat_file()) or {}
+    return 0 <= time.time() - beat.get('beat', 0) < HEARTBEAT_STALE
+
+
+def spool_entry_id():
+    return '{:020d}-{}-{}'.format(int(time.time() * 1e6), os.getpid(), threading.current_thread().ident)
+
+
+def spool_alert(search_name, csv_path):
+    """Queue a forwarding alert for the delivery daemon.
+
+    The results file is copied because Splunk may reap the search's dispatch
+    directory before the daemon gets to it.
+    """
+    path = state_file(SPOOL_DIR, spool_entry_id())
+    shutil.copyfile(csv_path, path + RESULTS_SUFFIX)
+    write_json(path + SPOOL_SUFFIX, {
+        'search_name': search_name,
+        'csv_path': csv_path,
+        'results': path + RESULTS_SUFFIX,
+        'queued': time.time(),
+    })
+    return path
+
+
+def spooled_alerts():
+    """Yield (path, entry) for the queued alerts, oldest first."""
+    try:
+        names = sorted(name for name in os.listdir(SPOOL_DIR) if name.endswith(SPOOL_SUFFIX))
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(SPOOL_DIR, name[:-len(SPOOL_SUFFIX)])
+        entry = read_json(path + SPOOL_SUFFIX)
+        if entry is not None:
+            yield path, entry
+
+
+def retry_spooled(path, entry):
+    """Keep an alert the daemon could not finish for a later attempt.
+
+    Returns False once it has used up its attempts.
+    """
+    attempts = entry.get('attempts', 0) + 1
+    if attempts >= SPOOL_MAX_ATTEMPTS:
+        return False
+    entry.update({
+        'attempts': attempts,
+        'retry_at': time.time() + SPOOL_RETRY_DELAY * 2 ** (attempts - 1),
+    })
+    write_json(path + SPOOL_SUFFIX, entry)
+    return True
+
+
+def remove_spooled(path):
+    for suffix in (SPOOL_SUFFIX, RESULTS_SUFFIX):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+def save_retry_item(splunk, uri, data):
+    """Post an item to the KV Store retry collection at `uri`, or keep it in
+    RETRY_DIR when the KV Store does not take it.
+
+    Returns True when it was posted; raises when it could not be kept either way.
+    """
+    try:
+        splunk.rest_kv(uri, data, 'POST')
+        return True
+    except Exception:
+        write_json(state_file(RETRY_DIR, spool_entry_id() + SPOOL_SUFFIX), data)
+        return False
+
+
+def queued_retry_items():
+    """Yield (path, item) for the retry items kept in RETRY_DIR, oldest first."""
+    try:
+        names = sorted(name for name in os.listdir(RETRY_DIR) if name.endswith(SPOOL_SUFFIX))
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(RETRY_DIR, name)
+        item = read_json(path)
+        if item is not None:
+            yield path, item
+
+
+class Heartbeat(object):
+    """Tells the alert scripts that a delivery daemon is taking spooled alerts.
+
+    The daemon beats from its main loop, so the heartbeat goes stale, and the
+    alerts forward their results themselves, once that loop stops making progress.
+    """
+    def __init__(self):
+        self.path = heartbeat_file()
+        self.last = 0
+
+    def beat(self):
+        now = time.time()
+        if now - self.last >= HEARTBEAT_INTERVAL:
+            write_json(self.path, {'pid': os.getpid(), 'beat': now})
+            self.last = now
+
+    def stop(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,162 @@
+# File: phantom_state.py
+# Copyright (c) 2016-2024 Splunk Inc.
+#
+# SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
+# without a valid written license from Splunk Inc. is PROHIBITED.
+
+import os
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Small JSON state files shared by every process of the app (alert actions,
+# scripted inputs and the REST handlers) on this Splunk instance
+RUN_DIR = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'run', 'splunk', 'phantom')
+# State that should survive a Splunk restart
+LIB_DIR = os.path.join(os.environ['SPLUNK_HOME'], 'var', 'lib', 'splunk', 'phantom')
+
+
+def state_file(directory, name):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return os.path.join(directory, name)
+
+
+def server_key(server):
+    return hashlib.sha256(server.encode('utf-8')).hexdigest()[:16]
+
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive lock on <path>.lock while the block runs."""
+    with open(path + '.lock', 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def write_json(path, value):
+    # write to a private file first so readers never see a partial document
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp, path)
+
+
+def load_cached(path, ttl):
+    entry = read_json(path)
+    if isinstance(entry, dict) and 0 <= time.time() - entry.get('saved', 0) < ttl:
+        return entry.get('data')
+    return None
+
+
+def save_cached(path, data):
+    write_json(path, {'saved': time.time(), 'data': data})
+
+
+def remove_state_files(directory, prefix):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(prefix):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+class PersistentMap(object):
+    """Bounded LRU map backed by a JSON file shared between processes.
+
+    The file is read on first use and new entries are merged back into it by
+    flush(). Entries older than ttl seconds are dropped.
+    """
+    def __init__(self, path, capacity, ttl):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._dirty = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        now = time.time()
+        for key, entry in (read_json(self.path) or {}).items():
+            if now - entry[1] < self.ttl:
+                self._entries[key] = entry
+
+    def get(self, key):
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] >= self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._load()
+            self._entries[key] = self._dirty[key] = [value, time.time()]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._load()
+            self._entries.pop(key, None)
+            # removed from the file on flush
+            self._dirty[key] = None
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            with locked(self.path):
+                entries = read_json(self.path) or {}
+                entries.update(self._dirty)
+                now = time.time()
+                fresh = sorted((item for item in entries.items() if item[1] is not None and now - item[1][1] < self.ttl), key=lambda item: item[1][1])
+                write_json(self.path, OrderedDict(fresh[-self.capacity:]))
+            self._dirty = {}
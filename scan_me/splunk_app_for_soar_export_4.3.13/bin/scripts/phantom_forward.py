@@ -6,13 +6,16 @@
 # SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
 # without a valid written license from Splunk Inc. is PROHIBITED.
 
-from copy import deepcopy
 import os, sys
 import csv, gzip
 from traceback import format_exc
 import json
-import re
+import multiprocessing
+import time
 import urllib
+from collections import deque
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 # import requests.packages.urllib3
 from sys import platform
 
@@ -26,58 +29,313 @@ from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
 script_path = os.path.join(os.environ['SPLUNK_HOME'], 'etc', 'apps', 'phantom', 'bin')
 sys.path.insert(0, script_path)
 
-from phantom_config import PhantomConfig, PHANTOM_KEY, VERIFY_KEY, SEVERITIES, get_safe
-from phantom_instance import PhantomInstance, NAME_KEY
+from phantom_config import PhantomConfig, PHANTOM_KEY, VERIFY_KEY, SEVERITIES, MAPPING_WORKERS, get_safe
+from phantom_instance import PhantomInstance, ExtractionPlan, ArtifactTemplate, SEVERITY_KEY, CONNECTION_ERRORS, flush_container_maps, get_int_setting, retryable_result, container_missing
+from phantom_checkpoint import ResultsCheckpoint
+from phantom_mv import MV_PREFIX, decode_mv, mv_fields
+from phantom_logging import LogSampler
+from phantom_spool import Heartbeat, daemon_alive, spool_alert, spooled_alerts, retry_spooled, remove_spooled, save_retry_item
 
 csv.field_size_limit(10485760)
 
 KV_STORE_PHANTOM_RETRY = "/servicesNS/nobody/phantom/storage/collections/data/phantom_retry"
 
-def load_csv(csv_path):
+# The delivery daemon exits after this long so Splunk restarts it with a fresh session key
+DAEMON_LIFETIME = 3600
+CONFIG_REFRESH = 60
+SPOOL_POLL = 0.5
+# spooled alerts forwarded at the same time
+DAEMON_WORKERS = 4
+# an alert starts no new rows after this long; the daemon resumes the rest later
+SPOOL_ENTRY_MAXTIME = 300
+# the heartbeat stops while every worker is this far past its alert's time limit
+SPOOL_ENTRY_GRACE = 60
+
+# rows sent to a mapping worker process at a time
+MAPPING_BATCH_ROWS = 500
+# results files smaller than this (compressed) are mapped in process
+MAPPING_POOL_MIN_BYTES = 1 << 20
+
+def open_results(csv_path):
   if sys.version_info[0] < 3:
     g = gzip.open(csv_path)
   else:
     g = gzip.open(csv_path, 'rt')
+  return csv.reader(g)
+
+def load_csv(csv_path):
   headers = []
-  for row in csv.reader(g):
+  for row in open_results(csv_path):
     if not headers:
       headers = row
       continue
     data = dict(zip(headers, row))
     yield data
 
-def fix_multiple_values(result):
+def fix_multiple_values(result, fields=None):
+  # fields: the columns with a __mv_ companion, from mv_fields(header)
+  if fields is None:
+    fields = mv_fields(result)
   d = dict() # contains keys/values with multiple values
-  for i in result:
-    try:
-        data = result['__mv_' + i]
-        r = re.findall(r'(?:\$\$;)?\$(.*?)(?:\$;|\n    \$;|\$$)', data)
+  for i in fields:
+    data = result[MV_PREFIX + i]
+    if data:
+        r = [item for item in decode_mv(data) if item]
         if len(r) > 0:
-            d['__mv_' + i] = d[i] = [item.replace('$$', '$') for item in r if item]
-    except:
-        pass
+            d[MV_PREFIX + i] = d[i] = r
   return d
 
 def add_cim_to_config(search_config, config):
-    cim = config.get_cim_mapping()
-    values = search_config.values()
-    for k in cim:
-        v = get_safe(cim, k, k)
+    index = config.get_cim_index()
+    values = set(v for v in search_config.values() if isinstance(v, str))
+    for k, v in index.cef.items():
         if v not in search_config and k not in values:
             search_config[v] = k
 
-def forward_csv(config, search_name, csv_path):
+class RowMapper(object):
+    """Maps the rows of one results file to their (cef, artifacts).
+
+    A copy is sent to each mapping worker process, so it only holds
+    picklable state.
+    """
+    def __init__(self, search, header, fips_enabled, severity_fallback):
+        self.search = search
+        self.header = list(header)
+        self.fips_enabled = fips_enabled
+        self.severity_fallback = severity_fallback
+        self.multi_value = mv_fields(self.header)
+        self.plan = ExtractionPlan(search, self.header)
+        self.template = ArtifactTemplate(search)
+
+    def map(self, data):
+        mul_vals = fix_multiple_values(data, self.multi_value)
+        for key, value in mul_vals.items():
+          data[key] = value
+        cef = PhantomInstance.find_patterns(data, self.search, self.plan)
+        # fingerprinted before the severity fallback replaces the row's tags
+        pk_str, pk_hash = PhantomInstance._get_pk(cef, self.search, self.fips_enabled)
+        if self.severity_fallback:
+           cef['_severity'] = 'high'
+           cef['tags'] = ['check_sase_severity']
+        artifacts = [self.template.build(cef, data, pk_hash)]
+        if self.severity_fallback:
+            for artifact in artifacts:
+                 artifact['severity'] = 'high'
+                 artifact['tags'] = ['check_sase_severity']
+        return cef, artifacts
+
+    def map_batch(self, batch):
+        header = self.header
+        return [ (row,) + self.map(dict(zip(header, values))) for row, values in batch ]
+
+_MAPPER = None
+
+def _init_mapping_worker(mapper):
+    global _MAPPER
+    _MAPPER = mapper
+    PhantomInstance.fips_enabled = mapper.fips_enabled
+
+def _map_batch(batch):
+    return _MAPPER.map_batch(batch)
+
+def row_batches(reader, checkpoint):
+    batch = []
+    for row, values in enumerate(reader):
+        if checkpoint.handled(row):
+            continue
+        batch.append((row, values))
+        if len(batch) >= MAPPING_BATCH_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def map_results(csv_path, search, fips_enabled, severity_fallback, checkpoint, workers):
+    """Yield (row, cef, artifacts) for the rows of a results file not yet
+    handled, in file order. With more than one worker, large files are
+    mapped in a pool of worker processes.
+    """
+    reader = open_results(csv_path)
+    header = next(reader, None)
+    if header is None:
+        return
+    mapper = RowMapper(search, header, fips_enabled, severity_fallback)
+    if workers < 2 or os.path.getsize(csv_path) < MAPPING_POOL_MIN_BYTES:
+        for batch in row_batches(reader, checkpoint):
+            for mapped in mapper.map_batch(batch):
+                yield mapped
+        return
+    pool = multiprocessing.Pool(workers, _init_mapping_worker, (mapper,))
+    try:
+        # keep every worker busy without reading the whole file ahead
+        pending = deque()
+        for batch in row_batches(reader, checkpoint):
+            pending.append(pool.apply_async(_map_batch, (batch,)))
+            if len(pending) >= 2 * workers:
+                for mapped in pending.popleft().get():
+                    yield mapped
+        while pending:
+            for mapped in pending.popleft().get():
+                yield mapped
+    finally:
+        pool.terminate()
+        pool.join()
+
+def deliver_row(pi, cef, search, artifacts):
+    succeeded, container_id, response = pi.get_or_create_container(artifacts[0], cef, search, artifacts)
+    if succeeded and pi.embeds_artifacts(artifacts):
+        # the artifacts were created along with the container
+        artifacts = []
+    for artifact in artifacts:
+        artifact['container_id'] = container_id
+    return succeeded, container_id, response, artifacts
+
+class DeliveryPipeline(object):
+    """Sends mapped rows to SOAR from a pool of max_in_flight workers.
+
+    Results are logged in the order the rows were added, and artifacts of
+    consecutive rows are grouped into bulk artifact requests. Once the server
+    stops answering or throttles or fails a batch of artifacts, nothing more
+    is sent and the (cef, artifacts) of every row that did not make it are
+    collected in undelivered. A row whose mapped container was deleted on
+    SOAR gets a new container.
+
+    on_commit(offset, sdis) is called, in row order, once a row and every row
+    before it have their container and artifacts in SOAR. After the first
+    undelivered row the offset is None and only the sdis of the rows that
+    were delivered are passed.
+    """
+    def __init__(self, config, pi, on_commit=None):
+        self.config = config
+        self.container_log = LogSampler(config.logger)
+        self.artifact_log = LogSampler(config.logger)
+        self.pi = pi
+        self.on_commit = on_commit
+        self.pool = ThreadPoolExecutor(max_workers=pi.max_in_flight)
+        self.in_flight = deque()
+        self.pending_artifacts = []
+        # the (cef, search, artifacts) of the rows the pending artifacts belong to
+        self.pending_rows = []
+        # the commit the pending artifacts complete
+        self.pending_offset = None
+        self.pending_sdis = []
+        self.undelivered = []
+
+    def add_row(self, cef, search, artifacts, offset=None):
+        # offset: the rows of the results file handled once this one is delivered
+        if self.undelivered:
+            self.undelivered.append((cef, artifacts))
+            return
+        mark = (offset, artifacts[0]['source_data_identifier'])
+        # get_or_create_container pops keys from the cef it is given
+        self._submit(self._row_done, [(cef, search, artifacts)], mark, deliver_row, self.pi, dict(cef), search, artifacts)
+        self._drain(self.pi.max_in_flight)
+
+    def close(self):
+        try:
+            while self.in_flight or self.pending_artifacts:
+                self._flush()
+                self._drain(0)
+        finally:
+            self.pool.shutdown()
+
+    def _submit(self, on_done, rows, mark, fn, *args):
+        self.in_flight.append((self.pool.submit(fn, *args), on_done, rows, mark))
+
+    def _lost_connection(self, rows):
+        if not self.undelivered:
+            self.config.logger.error("Lost connection to SOAR. Will be posting to KV Store to retry later")
+        self.undelivered.extend((cef, artifacts) for cef, search, artifacts in rows)
+
+    def _drain(self, limit):
+        while len(self.in_flight) > limit:
+            future, on_done, rows, mark = self.in_flight.popleft()
+            try:
+                result = future.result()
+            except CONNECTION_ERRORS:
+                self._lost_connection(rows)
+                continue
+            on_done(result, mark, rows)
+
+    def _flush(self):
+        if self.pending_artifacts:
+            artifacts, self.pending_artifacts = self.pending_artifacts, []
+            rows, self.pending_rows = self.pending_rows, []
+            mark, self.pending_sdis = (self.pending_offset, self.pending_sdis), []
+            if self.undelivered:
+                self.undelivered.extend((cef, artifacts) for cef, search, artifacts in rows)
+            else:
+                self._submit(self._artifacts_done, rows, mark, self.pi.post_artifacts, artifacts)
+
+    def _commit(self, offset, sdis):
+        if self.on_commit is None:
+            return
+        if self.undelivered:
+            undelivered = set(artifacts[0]['source_data_identifier'] for cef, artifacts in self.undelivered if artifacts)
+            sdis = [ sdi for sdi in sdis if sdi not in undelivered ]
+            offset = None
+        self.on_commit(offset, sdis)
+
+    def _row_done(self, result, mark, rows):
+        succeeded, container_id, response, artifacts = result
+        self.container_log('succeeded: %s, container_id: %s, response: %s', succeeded, container_id, response)
+        if artifacts:
+            cef, search = rows[0][:2]
+            self.pending_rows.append((cef, search, artifacts))
+        self.pending_artifacts.extend(artifacts)
+        self.pending_offset, sdi = mark
+        self.pending_sdis.append(sdi)
+        if not self.pending_artifacts:
+            self._commit(self.pending_offset, self.pending_sdis)
+            self.pending_sdis = []
+        elif len(self.pending_artifacts) >= self.pi.artifact_batch_size:
+            self._flush()
+
+    def _artifacts_done(self, results, mark, rows):
+        results = iter(results)
+        lost = []
+        for cef, search, artifacts in rows:
+            if not self._check_artifacts(cef, artifacts, results):
+                lost.append((cef, search, artifacts))
+        for cef, search, artifacts in lost:
+            self.config.logger.info('Container of {} was deleted on SOAR. Creating it again'.format(artifacts[0]['source_data_identifier']))
+            self.pi.forget_container(artifacts[0]['source_data_identifier'])
+            try:
+                succeeded, container_id, response, artifacts = deliver_row(self.pi, dict(cef), search, artifacts)
+                self.container_log('succeeded: %s, container_id: %s, response: %s', succeeded, container_id, response)
+                self._check_artifacts(cef, artifacts, iter(self.pi.post_artifacts(artifacts)))
+            except CONNECTION_ERRORS:
+                self._lost_connection([(cef, search, artifacts)])
+        self._commit(*mark)
+
+    def _check_artifacts(self, cef, artifacts, results):
+        # False when the artifacts of the row failed as their container no longer exists
+        failed = []
+        missing = False
+        for artifact, (created, artifact_id, result, container) in zip(artifacts, results):
+            self.artifact_log('new artifact: %s', (created, artifact_id, result, container))
+            if artifact_id is None and retryable_result(result):
+                failed.append(artifact)
+            elif artifact_id is None and container_missing(result):
+                missing = True
+        if failed:
+            # throttled or failed by SOAR as a batch, so they go to the retry collection
+            self.undelivered.append((cef, failed))
+        return not missing or bool(failed)
+
+def forward_csv(config, search_name, csv_path, results_file=None, deadline=None):
+    # results_file: the search's results file when csv_path is a spooled copy of it.
+    # deadline: time after which no new rows are started.
+    # Returns False when rows are left that a later run over the same results should deliver
     config.logger.info("Search name: {}".format(unquote(search_name)))
-    search = None
-    for fwd in config.get_forwarding_configs():
-        if fwd[NAME_KEY] == search_name:
-            search = fwd
-            break
+    search = config.get_forwarding_config(search_name)
     if not search:
         config.logger.error('Error loading config for search {!r}'.format(search_name))
         return
+    # add_cim_to_config fills it in, and the daemon's workers share the config
+    search = deepcopy(search)
 
-    target = config.get_server_config(fwd['_target'])
+    target = config.get_server_config(search['_target'])
     if not target:
         raise Exception('Cannot find search target ({}) in server configurations'.format(search['_target']))
     if not target.get('arrelay'):
@@ -96,56 +354,54 @@ def forward_csv(config, search_name, csv_path):
 
     container_to_send = []
     artifacts_to_send = []
+    checkpoint = ResultsCheckpoint(search_name, results_file or csv_path)
+    if checkpoint.resumed:
+        config.logger.info("Resuming results of sid {} after row {}".format(checkpoint.sid, checkpoint.resumed))
     container_id = None
-    search_results = load_csv(csv_path)
-    # config.logger.info("search results: {}".format(search_results))
-    for data in search_results:
-        # config.logger.info(str({'search_results': data}))
-        if search.get('_savedsearch'):
-            add_cim_to_config(search, config)
-        mul_vals = fix_multiple_values(data)
-        for key, value in mul_vals.items():
-          data[key] = value
-        cef = pi.find_patterns(data, search)
-
-        severity = cef['_severity']
-        config_severities = config[SEVERITIES]
-        if valid_ph_connection is True and len(config_severities.get(target['ph_auth_config_id'], [])) > 0:
-          severity_exists = pi.check_severity(severity)
-          if severity_exists is False:
-              config.logger.error("Severity '{}' does not exist in SOAR. Sending artifact with 'high' severity and container and artifact tag 'check_sase_severity'.".format(severity))
-              valid_severity = False
-        cef_copy = deepcopy(cef)
-        
-        if valid_severity is False:
-           cef_copy['_severity'] = 'high'
-           cef_copy['tags'] = ['check_sase_severity']
-           cef = cef_copy
-        artifacts = pi.create_artifacts(cef, data, search)
-        config.logger.info(str({'artifacts': artifacts}))
-        if not artifacts:
+    if search.get('_savedsearch'):
+        # only adds the CIM fields that are missing, so once covers every row
+        add_cim_to_config(search, config)
+
+    # every row gets the severity of the search
+    severity = search.get(SEVERITY_KEY)
+    config_severities = config[SEVERITIES]
+    if severity is not None and valid_ph_connection is True and len(config_severities.get(target['ph_auth_config_id'], [])) > 0:
+      severity_exists = pi.check_severity(severity)
+      if severity_exists is False:
+          config.logger.error("Severity '{}' does not exist in SOAR. Sending artifact with 'high' severity and container and artifact tag 'check_sase_severity'.".format(severity))
+          valid_severity = False
+
+    workers = get_int_setting(config, MAPPING_WORKERS, 0)
+    search_results = map_results(csv_path, search, config.fips_is_enabled, not valid_severity, checkpoint, workers)
+    # the pipeline only starts its threads on the first row, after the mapping processes
+    pipeline = DeliveryPipeline(config, pi, checkpoint.commit)
+    row_log = LogSampler(config.logger)
+    stopped_at = None
+    for row, cef, artifacts in search_results:
+        if deadline is not None and time.time() >= deadline:
+            stopped_at = row
+            search_results.close()
+            break
+        row_log('artifacts: %s', artifacts)
+        if not artifacts or checkpoint.handled(row, artifacts[0]['source_data_identifier']):
             continue
         key, value = config.splunk.get_return_url(search, artifacts[0].get('data', {}))
         if key and value:
             artifacts[0]['cef'][key] = value
         if valid_ph_connection == True:
-          succeeded, container_id, response = pi.get_or_create_container(artifacts[0], cef, search)
-          config.logger.info("succeeded: {}, container_id: {}, response: {}".format(succeeded, container_id, response))
-          config.logger.info(str({'new_container': container_id}))
-        else:
-          container_to_send = {"cef": cef, "search_config": search}
+          pipeline.add_row(cef, search, artifacts, row + 1)
+          continue
+        container_to_send = {"cef": cef, "search_config": search}
         for artifact in artifacts:
-            if valid_severity == False:
-                 new_artifact = deepcopy(artifact)
-                 new_artifact['severity'] = 'high'
-                 new_artifact['tags'] = ['check_sase_severity']
-                 artifact = new_artifact
             artifact['container_id'] = container_id
-            if valid_ph_connection == True:
-              artifact_id = pi.post_artifact(artifact)
-              config.logger.info(str({'new artifact': artifact_id}))
-            else:
-              artifacts_to_send.append(artifact)
+            artifacts_to_send.append(artifact)
+    pipeline.close()
+    flush_container_maps()
+    for cef, artifacts in pipeline.undelivered:
+        container_to_send = {"cef": cef, "search_config": search}
+        for artifact in artifacts:
+            artifact['container_id'] = None
+            artifacts_to_send.append(artifact)
     if len(container_to_send) > 0:
       try:
         data = {
@@ -154,10 +410,108 @@ def forward_csv(config, search_name, csv_path):
             'artifacts': artifacts_to_send,
             'server_settings': target['ph_auth_config_id']
         }
-        success, content = config.splunk.rest_kv(KV_STORE_PHANTOM_RETRY, data, "POST")
-        config.logger.info("Posted to KV store for retry later: {}. content: {}".format(success, content))
+        if save_retry_item(config.splunk, KV_STORE_PHANTOM_RETRY, data):
+            config.logger.info("Posted to KV store for retry later")
+        else:
+            config.logger.error("Could not post failed data to KV store. Kept it for the retry input to post")
       except Exception as e:
-        config.logger.error("Could not post failed data to KV store. Error {}".format(e))
+        config.logger.error("Could not save failed data for retry. Error {}".format(e))
+        # the checkpoint stops at the first row that was not delivered
+        return False
+    if stopped_at is not None:
+        # every row before it was delivered or queued for retry
+        config.logger.info("Stopped at row {} of sid {} after the time limit".format(stopped_at, checkpoint.sid))
+        checkpoint.commit(stopped_at)
+        checkpoint.save()
+        return False
+    checkpoint.complete()
+    return True
+
+class DeliveryDaemon(object):
+    """Forwards the alerts spooled by the phantom_forward.py alert runs.
+
+    Runs as the app's scripted input and keeps the config, the SOAR sessions
+    and the server caches warm across alerts. Up to DAEMON_WORKERS alerts are
+    forwarded at once, each for at most SPOOL_ENTRY_MAXTIME seconds at a time.
+    """
+    def __init__(self, session_key):
+        self.session_key = session_key
+        self.config = None
+        self.loaded = 0
+        self.pool = ThreadPoolExecutor(max_workers=DAEMON_WORKERS)
+        # spool path -> (future, deadline) of the alerts being forwarded
+        self.running = {}
+
+    def load_config(self):
+        # a new object, so alerts already handed to workers keep the config they started with
+        self.config = PhantomConfig('forwarding', self.session_key)
+        self.loaded = time.time()
+
+    def has_search(self, search_name):
+        return self.config.get_forwarding_config(search_name) is not None
+
+    def deliver(self, config, path, entry, deadline):
+        finished = False
+        try:
+            config.logger.info('csv {!r} search {!r} queued {:.1f}s ago'.format(
+                entry['csv_path'], unquote(entry['search_name']), time.time() - entry['queued']))
+            finished = forward_csv(config, entry['search_name'], entry['results'], entry['csv_path'], deadline) is not False
+        except Exception:
+            config.logger.error(format_exc())
+        finally:
+            if finished:
+                remove_spooled(path)
+            elif retry_spooled(path, entry):
+                # the next attempt resumes from the checkpoint
+                config.logger.info('csv {!r} search {!r} is retried after attempt {}'.format(
+                    entry['csv_path'], unquote(entry['search_name']), entry['attempts']))
+            else:
+                config.logger.error('csv {!r} search {!r} dropped after {} attempts'.format(
+                    entry['csv_path'], unquote(entry['search_name']), entry.get('attempts', 0) + 1))
+                remove_spooled(path)
+
+    def deliver_spooled(self):
+        # hands due alerts to free workers and returns how many were started
+        for path, (future, deadline) in list(self.running.items()):
+            if future.done():
+                del self.running[path]
+        started = 0
+        for path, entry in spooled_alerts():
+            if len(self.running) >= DAEMON_WORKERS:
+                break
+            if path in self.running or entry.get('retry_at', 0) > time.time():
+                continue
+            if not self.has_search(entry['search_name']):
+                # saved after the config was loaded
+                self.load_config()
+            deadline = time.time() + SPOOL_ENTRY_MAXTIME
+            self.running[path] = (self.pool.submit(self.deliver, self.config, path, entry, deadline), deadline)
+            started += 1
+        return started
+
+    def stuck(self):
+        # every worker is on an alert that overran its time limit
+        now = time.time()
+        return len(self.running) >= DAEMON_WORKERS and all(now > deadline + SPOOL_ENTRY_GRACE for future, deadline in self.running.values())
+
+    def run(self):
+        self.load_config()
+        started = time.time()
+        heartbeat = Heartbeat()
+        try:
+            while time.time() - started < DAEMON_LIFETIME:
+                if not self.stuck():
+                    heartbeat.beat()
+                if time.time() - self.loaded >= CONFIG_REFRESH:
+                    self.load_config()
+                if not self.deliver_spooled():
+                    time.sleep(SPOOL_POLL)
+        finally:
+            heartbeat.stop()
+        # alerts spooled while the heartbeat was going away
+        while self.deliver_spooled() or self.running:
+            time.sleep(SPOOL_POLL)
+        self.pool.shutdown()
 
 def remove_carets(data):
   ans = []
@@ -196,20 +550,36 @@ if __name__ == '__main__':
         logger.error('{} called without a session token.'.format(sys.argv[0]))
         sys.exit(0)
     if len(sys.argv) < 9:
-        logger = PhantomConfig.get_logger('forwarding')
-        # logger.error('{} called without the correct set of parameters.'.format(sys.argv[0]))
+        # started as the app's scripted input rather than by an alert
+        try:
+            DeliveryDaemon(session_key).run()
+        except Exception as e:
+            logger = PhantomConfig.get_logger('forwarding')
+            logger.error(format_exc())
         sys.exit(0)
     try:
-        config = PhantomConfig('forwarding', session_key)
         csv_path = os.path.join(sys.argv[8])
         search_name = sys.argv[4]
         if search_name.startswith('_phantom_app_'):
             search_name = search_name[13:]
         if platform.startswith('win'):  # If Windows, need to clean up input
             search_name = remove_carets(search_name)
+        if os.path.exists(csv_path) and daemon_alive():
+            spool_alert(search_name, csv_path)
+            logger = PhantomConfig.get_logger('forwarding')
+            logger.info('csv {!r} search {!r} spooled for the delivery daemon'.format(csv_path, unquote(search_name)))
+            sys.exit(0)
+        config = PhantomConfig.for_search('forwarding', session_key, search_name)
         config.logger.info('csv {!r} search {!r}'.format(csv_path, unquote(search_name)))
         if os.path.exists(csv_path) is True:
-          forward_csv(config, search_name, csv_path)
+          finished = False
+          try:
+            finished = forward_csv(config, search_name, csv_path) is not False
+          finally:
+            if not finished:
+              # the delivery daemon resumes it from the checkpoint
+              spool_alert(search_name, csv_path)
+              config.logger.info('csv {!r} search {!r} spooled for the delivery daemon to finish'.format(csv_path, unquote(search_name)))
         else:
           config.logger.info("csv_path does not exist. No events found. Exiting...")
     except Exception as e:
@@ -17,13 +17,17 @@
 # SPLUNK CONFIDENTIAL - Use or disclosure of this material in whole or in part
 # without a valid written license from Splunk Inc. is PROHIBITED.
 
-from copy import deepcopy
+import os
 import sys
 import json
+import random
+import time
 from splunk.appserver.mrsparkle.lib.util import make_splunkhome_path
 from splunk.clilib.bundle_paths import make_splunkhome_path
 from phantom_config import PhantomConfig, PHANTOM_KEY, VERIFY_KEY, SEVERITIES, get_safe
-from phantom_instance import PhantomInstance, NAME_KEY
+from phantom_instance import PhantomInstance, NAME_KEY, flush_container_maps, container_missing
+from phantom_logging import LogSampler
+from phantom_spool import queued_retry_items
 
 from phantom_imports import (
     KV_STORE_PHANTOM_ENDPOINT,
@@ -36,6 +40,14 @@ sys.path.insert(0, script_path)
 COMPONENT_RETRY = 'retry'
 INVALID_LABEL_ERROR = "is not a known label."
 
+# An item that fails again waits RETRY_BASE_DELAY * 2^(attempts - 1) seconds, at most
+# RETRY_MAX_DELAY, less up to half of it at random so items failed by one outage spread out.
+# It is dropped after RETRY_MAX_ATTEMPTS attempts, unless SOAR could not be reached.
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 6 * 3600
+RETRY_MAX_ATTEMPTS = 12
+RETRY_PAGE_SIZE = 250
+
 # Empty introspection routine
 def do_scheme():
     pass
@@ -54,14 +66,84 @@ def get_kv_store_count(config):
 
     return int(count)
 
+def retry_delay(attempts):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** min(attempts - 1, 16))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def due_page():
+    # items saved before attempts were tracked have no next_attempt_at and sort first
+    return {'limit': RETRY_PAGE_SIZE, 'sort': 'next_attempt_at'}
+
+def due_items(config, uri, page):
+    """Yield the items of `page` that are due, then those of the next pages
+    while there are any, so a backlog drains in one run.
+
+    Handled items are deleted or moved back by reschedule, so every page is
+    read from the start of the collection.
+    """
+    seen = set()
+    while page:
+        now = time.time()
+        due = [ item for item in page if item['_key'] not in seen and (item.get('next_attempt_at') or 0) <= now ]
+        if not due:
+            return
+        for item in due:
+            seen.add(item['_key'])
+            yield item
+        success, content = config.splunk.rest_kv(uri, due_page(), "GET")
+        if success is not True:
+            return
+        page = json.loads(content.decode('utf-8'))
+
+def reschedule(config, uri, record, error, reachable=True):
+    # record: the item as read from the KV Store. Items are only dropped for
+    # failures SOAR reported, not while it cannot be reached.
+    item = json.loads(record)
+    uri_item = "{uri}/{key}".format(uri=uri, key=item.pop('_key'))
+    item.pop('_user', None)
+    attempts = int(item.get('attempts') or 0) + 1
+    try:
+        if attempts >= RETRY_MAX_ATTEMPTS and reachable:
+            config.logger.error("Failed item could not be posted to SOAR in {} attempts. Item deleted from KV Store. Last error: {}".format(attempts, error))
+            config.splunk.rest_kv(uri_item, {}, 'DELETE')
+            return
+        item.update({
+            'attempts': attempts,
+            'next_attempt_at': time.time() + retry_delay(attempts),
+            'last_error': str(error)[:1024] if error else '',
+        })
+        config.splunk.rest_kv(uri_item, item, 'POST')
+    except Exception as e:
+        config.logger.error("Could not reschedule failed item: {}".format(e))
+
+def post_kept_items(config, collection):
+    # items the alerts kept on disk because the KV Store did not take them
+    uri = "{endpoint}/{collection}".format(endpoint=KV_STORE_PHANTOM_ENDPOINT, collection=collection)
+    posted = 0
+    for path, item in queued_retry_items():
+        try:
+            config.splunk.rest_kv(uri, item, 'POST')
+        except Exception as e:
+            config.logger.error("Could not post kept items to KV Store {}: {}".format(collection, e))
+            break
+        os.remove(path)
+        posted += 1
+    if posted:
+        config.logger.info("Posted {} kept items to KV Store {}".format(posted, collection))
+
 def query_kv_store(config, logger, collection):
     uri = "{endpoint}/{collection}".format(endpoint=KV_STORE_PHANTOM_ENDPOINT, collection=collection)
-    success, content = config.splunk.rest_kv(uri, {'limit': 250}, "GET")
+    success, content = config.splunk.rest_kv(uri, due_page(), "GET")
     if success is True:
         content = json.loads(content.decode('utf-8'))
+        container_log = LogSampler(config.logger)
+        artifact_log = LogSampler(config.logger)
         if len(content) > 0:
-            for item in content:
+            for item in due_items(config, uri, content):
                 can_delete_from_kv = True
+                last_error = None
+                reachable = True
+                record = json.dumps(item)
                 try:
                     container_id = None
                     server = config[PHANTOM_KEY]
@@ -76,6 +158,8 @@ def query_kv_store(config, logger, collection):
                     except:
                         valid_ph_connection = False
                         can_delete_from_kv = False
+                        reachable = False
+                        last_error = 'Could not verify connection to SOAR'
                         config.logger.error(f"Could not verify connection to SOAR server '{server_settings['custom_name']}'. Retry post to SOAR later.")
 
                     if valid_ph_connection == True:
@@ -116,14 +200,22 @@ def query_kv_store(config, logger, collection):
                             name = item['container']['name']
                             config.logger.info("Trying rule_id '{name}' source_data_identifier '{sdi}'".format(name=name, sdi=sdi))
 
+                            label = item['container'].get('label')
+                            if label and not pi.check_label(label):
+                                config.logger.info("Label '{}' is not known to SOAR. Attempting to delete failed item containing invalid label from KV Store".format(label))
+                                uri_item = "{uri}/{key}".format(uri=uri, key=item['_key'])
+                                success, content = config.splunk.rest_kv(uri_item, {}, 'DELETE')
+                                if success is True:
+                                    config.logger.info("Failed item contained invalid label. Item deleted from KV Store")
+                                continue
+
                             # Try creating container in SOAR
                             response = pi.post('/rest/container', item['container'])
-                            resp_json = response.json()
-                            container_id = response.json().get('id')
+                            container_id = response.id
                             if not container_id:
-                                container_id = response.json().get('existing_container_id')
+                                container_id = response.existing_container_id
                             if not container_id:
-                                message = response.json().get('message')
+                                message = response.message or ''
                                 if INVALID_LABEL_ERROR in message:
                                     config.logger.info("Attempting to delete failed item containing invalid label from KV Store")
                                     uri_item = "{uri}/{key}".format(uri=uri, key=item['_key'])
@@ -131,25 +223,25 @@ def query_kv_store(config, logger, collection):
                                     if success is True:
                                         config.logger.info("Failed item contained invalid label. Item deleted from KV Store")
                                 else:
-                                    config.logger.error('Unable to create container: ' + response.json().get('message'))
+                                    config.logger.error('Unable to create container: ' + message)
                                     can_delete_from_kv = False
+                                    last_error = message
                                 continue
                             else:
                                 server = server_settings['server']
                                 msg = { 'container_id': container_id, 'container_url': '{server}/mission/{container_id}'.format(server=server, container_id=container_id), 'success': 'true' }
                                 config.logger.info(msg)
                             # Try creating artifact(s) for the container
-                            for art in item['artifacts']:
-                                art_item = art
+                            for art_item in item['artifacts']:
                                 art_item.update({ 'container_id': container_id })
                                 if severity_exists is False:
                                     config.logger.info(f"Severity '{art_item['severity']}' does not exist in SOAR. Sending artifact with 'high' severity and artifact tag 'check_sase_severity.")
                                     art_item.update({ 'severity': severity, 'tags': ['check_sase_severity'] })
-                                created, artifact_id, response, c = pi.post_artifact(art_item)
-                                resp_json = response.json()
-                                config.logger.info(resp_json)
+                            for created, artifact_id, resp_json, c in pi.post_artifacts(item['artifacts']):
+                                artifact_log('%s', resp_json)
                                 if created is False and resp_json.get('existing_artifact_id') is None:
                                     can_delete_from_kv = False
+                                    last_error = resp_json.get('message')
                             if item.get('playbook') is not None:
                                 playbook_item = item['playbook']
                                 playbook_item.update({ 'container_id': container_id })
@@ -167,37 +259,49 @@ def query_kv_store(config, logger, collection):
                                 cef = item['container']['cef']
                                 sensitivity = item['container']['cef']['_sensitivity']
                                 severity = item['container']['cef']['_severity']
-                                item_cef = deepcopy(cef)
-                                item_search_config = deepcopy(item['container']['search_config'])
+                                # get_or_create_container pops the container keys from the cef
+                                item_cef = dict(cef)
+                                item_search_config = item['container']['search_config']
                                 key, value = config.splunk.get_return_url(item_search_config, item_artifact.get('data', {}))
                                 if key and value:
                                     item_artifact['cef'][key] = value
                                 succeeded, container_id, response = pi.get_or_create_container(item_artifact, item_cef, item_search_config)
-                                config.logger.info("succeeded: {}, container_id: {}, response: {}".format(succeeded, container_id, response))
+                                container_log('succeeded: %s, container_id: %s, response: %s', succeeded, container_id, response)
                                 if 'Severity matching query does not exist.' in str(response):
                                     config.logger.error(f"Severity '{severity}' does not exist in SOAR. Sending container with 'high' severity and container tag 'check_sase_severity'.")
                                     item_cef['_sensitivity'] = sensitivity
                                     item_cef['_severity'] = 'high'
                                     item_cef['tags'] = ['check_sase_severity']
                                     succeeded, container_id, response = pi.get_or_create_container(item_artifact, item_cef, item_search_config)
-                                config.logger.info(str({'new_container': container_id}))
-
                                 item_artifact.update({ 'container_id': container_id })
-                                created, artifact_id, response, c = pi.post_artifact(item_artifact)
-                                resp_json = response.json()
+
+                            retry_artifacts = []
+                            for item_artifact, (created, artifact_id, resp_json, c) in zip(item['artifacts'], pi.post_artifacts(item['artifacts'])):
                                 if 'Severity matching query does not exist.' in resp_json.get('message', ''):
                                     config.logger.info(f"Severity '{item_artifact['severity']}' does not exist in SOAR. Sending artifact with 'high' severity and artifact tag 'check_sase_severity.")
                                     item_artifact.update({
                                         'severity': 'high',
                                         'tags': ['check_sase_severity']
                                     })
-                                    created, artifact_id, response, c = pi.post_artifact(item_artifact)
-                                    resp_json = response.json()
-                                    config.logger.info(resp_json)
-                                else:
-                                    config.logger.info(resp_json)
+                                    retry_artifacts.append(item_artifact)
+                                    continue
+                                if artifact_id is None and container_missing(resp_json):
+                                    # the mapped container was deleted on SOAR, so create it again
+                                    pi.forget_container(item_artifact['source_data_identifier'])
+                                    succeeded, container_id, response = pi.get_or_create_container(item_artifact, dict(cef), item_search_config)
+                                    container_log('succeeded: %s, container_id: %s, response: %s', succeeded, container_id, response)
+                                    item_artifact.update({ 'container_id': container_id })
+                                    retry_artifacts.append(item_artifact)
+                                    continue
+                                artifact_log('%s', resp_json)
+                                if created is False and resp_json.get('existing_artifact_id') is None:
+                                    can_delete_from_kv = False
+                                    last_error = resp_json.get('message')
+                            for created, artifact_id, resp_json, c in pi.post_artifacts(retry_artifacts):
+                                artifact_log('%s', resp_json)
                                 if created is False and resp_json.get('existing_artifact_id') is None:
                                     can_delete_from_kv = False
+                                    last_error = resp_json.get('message')
                         
                     if can_delete_from_kv is True:
                         uri_item = "{uri}/{key}".format(uri=uri, key=item['_key'])
@@ -213,7 +317,12 @@ def query_kv_store(config, logger, collection):
                         if success is True:
                             config.logger.info("Failed item contained invalid label. Item deleted from KV Store")
                     else:
-                        pass
+                        can_delete_from_kv = False
+                        last_error = message
+                finally:
+                    if can_delete_from_kv is False:
+                        reschedule(config, uri, record, last_error, reachable)
+            flush_container_maps()
     else:
         config.logger.error("Error retrieving items from KV Store {collection}".format(collection=collection))
 
@@ -240,6 +349,7 @@ if __name__ == '__main__':
         config = PhantomConfig(COMPONENT_RETRY, session_key)
         try:
             config.logger.info("Mod Input Retry")
+            post_kept_items(config, KV_STORE_PHANTOM_RETRY)
             num_items = get_kv_store_count(config)
             if num_items > 0:
                 config.logger.info("Num items in KV Store: {}".format(num_items))
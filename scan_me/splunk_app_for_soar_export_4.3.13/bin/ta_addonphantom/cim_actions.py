@@ -22,6 +22,8 @@ from splunk.clilib.cli_common import getConfKeyValue
 from splunk.clilib.bundle_paths import make_splunkhome_path
 from splunk.util import mktimegm, normalizeBoolean
 
+from phantom_mv import decode_mv
+
 # Python 2+3 basestring
 try:
     basestring
@@ -67,36 +69,7 @@ def default_mapexp(x):
 
 
 def parse_mv(mvstr):
-    grab = False
-    escape_idx = None
-    vals = []
-
-    for c, char in enumerate(mvstr):
-        if char == '$':
-            # literal
-            if c - 1 == escape_idx:
-                escape_idx = None
-            elif grab:
-                nchar = mvstr[c + 1] if len(mvstr) - 1 > c else None
-                # escape
-                if nchar == '$':
-                    escape_idx = c
-                    continue
-                # stop
-                else:
-                    grab = False
-                    escape_idx = None
-                    continue
-            # start
-            else:
-                grab = True
-                vals.append('')
-                continue
-
-        if grab:
-            vals[-1] += char
-
-    return vals
+    return decode_mv(mvstr)
 
 
 class InvalidResultID(Exception):
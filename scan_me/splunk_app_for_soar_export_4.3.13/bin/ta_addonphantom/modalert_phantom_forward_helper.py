@@ -22,7 +22,10 @@ import splunklib.client as client
 import splunklib.results as results
 
 from phantom_config import PhantomConfig, PHANTOM_KEY, get_safe, VERIFY_KEY, SEVERITIES
-from phantom_instance import PhantomInstance, NAME_KEY
+from phantom_instance import PhantomInstance, NAME_KEY, CONNECTION_ERRORS, retryable_result
+from phantom_mv import MV_PREFIX, decode_mv
+from phantom_checkpoint import ResultsCheckpoint
+from phantom_spool import save_retry_item
 
 try:
     from cim_actions import ModularActionTimer
@@ -88,14 +91,10 @@ def check_for_custom_multiple_values(result):
             comment_value = format_comment_data(result.get('__mv_comment', ''))
             if len(comment_value) > 0:
                 d[i] = comment_value
-        else:
-            try:
-                data = result['__mv_' + i]
-                r = re.findall(r'(?:\$\$;)?\$(.*?)(?:\$;|\n    \$;|\$$)', data)
-                if len(r) > 0:
-                    d[i] = [item.replace('$$', '$') for item in r if item]
-            except:
-                pass
+        elif result.get(MV_PREFIX + i):
+            r = [item for item in decode_mv(result[MV_PREFIX + i]) if item]
+            if len(r) > 0:
+                d[i] = r
     if len(d) > 0:
         return True, d, custom_keys
     return False, d, custom_keys
@@ -120,8 +119,7 @@ def artifact_from_event(self, result, container, config, additional_keys):
         artifact['tags'] = ['check_sase_severity']
     artifact['severity'] = self.severity
     artifact['label'] = self.settings.get('configuration', {}).get('label', 'event')
-    cim_cef_map = additional_keys
-    cim_cef_map.update(config.get_cim_mapping())
+    cim_index = config.get_cim_index()
     for k, v in result.items():
         if k == '_time':
             artifact['start_time'] = artifact['end_time']  = datetime.utcfromtimestamp(float(v)).isoformat() + 'Z'
@@ -139,12 +137,10 @@ def artifact_from_event(self, result, container, config, additional_keys):
         else:
             if k == '_bkt':
                 notable["orig_bkt"] = v
-            cef_k = get_safe(cim_cef_map, k, None)
+            cef_k = cim_index.cef_name(k) or additional_keys.get(k)
             data[k] = v
             if cef_k:
                 cef[cef_k] = v
-            elif k in cim_cef_map:
-                cef[k] = v
             
 
     # Only works if not using AR Relay since you cannot search events on the SH from the HF
@@ -380,9 +376,14 @@ def process_event(helper, *args, **kwargs):
             helper.severity_fail = True
 
     results = []
+    checkpoint = ResultsCheckpoint(helper.action_name, helper.results_file, helper.settings.get('sid'))
+    if checkpoint.resumed:
+        helper.log_info(f"Resuming results of sid {checkpoint.sid} after row {checkpoint.resumed}")
     with ModularActionTimer(helper, 'main', helper.start_timer):
         with gzip.open(helper.results_file, 'rt') as fh:
             for num, result in enumerate(csv.DictReader(fh)):
+                if checkpoint.handled(num):
+                    continue
                 result.setdefault('rid', num)
                 result.setdefault('sid', helper.settings.get('sid'))
                 result.setdefault('tag', 'modaction')
@@ -397,34 +398,7 @@ def process_event(helper, *args, **kwargs):
                 artifacts_to_send = []
                 playbook_to_send = None
                 try:
-                    if valid_ph_connection is True:
-                        response = pi.post('/rest/container', container)
-                        response = response.json()
-                        if 'Severity matching query does not exist.' in response.get('message', ''):
-                            helper.log_error("Severity label does not exist in SOAR. Sending event with artifact tag 'check_sase_severity'.")
-                            valid_ph_connection = False
-                            container['severity'] = 'high'
-                            container_to_send = container
-                            helper.severity_fail = True
-                        else:
-                            container_id = response.get('id')
-                            created = True
-                            if not container_id:
-                                container_id = response.get('existing_container_id')
-                                created = False
-                            if not container_id:
-                                helper.log_error(f"Unable to create container: {response.get('message')}")
-                                helper.message("", status="failure")
-                                _write_events(helper)
-                                return 1
-                            if created:
-                                _add_event(helper, response)
-                            container['id'] = container_id
-                            resp = notable_data.copy()
-                            resp.update({ 'container_id' : container['id'], 'container_url': '{}/mission/{}'.format(pi.server, container['id']), 'success': 'true' })
-                            _add_event(helper, resp)
-                    else:
-                        container_to_send = container
+                    artifacts_to_post = []
                     loop, mul_vals, custom_keys = check_for_custom_multiple_values(result)
                     additional_keys = {"{}".format(x): "{}".format(x) for x in custom_keys}
                     if loop:
@@ -438,14 +412,7 @@ def process_event(helper, *args, **kwargs):
                             
                             artifact = artifact_from_event(helper, new_res, container, config, additional_keys)
                             artifact['cef']['_originating_search'] = helper.settings.get('results_link')
-                            if valid_ph_connection is True:
-                                created, artifact_id, response, c = pi.post_artifact(artifact)
-                                results.append((container, artifact))
-                                resp = notable_data.copy()
-                                resp.update(response.json())
-                                _add_event(helper, resp)
-                            else:
-                                artifacts_to_send.append(artifact)
+                            artifacts_to_post.append(artifact)
                         else:
                             # Get largest list
                             largest = { 'key': '', 'size': 0 }
@@ -472,25 +439,58 @@ def process_event(helper, *args, **kwargs):
 
                                 artifact = artifact_from_event(helper, new_res, container, config, additional_keys)
                                 artifact['cef']['_originating_search'] = helper.settings.get('results_link')
-                                if valid_ph_connection is True:
-                                    created, artifact_id, response, c = pi.post_artifact(artifact)
-                                    results.append((container, artifact))
-                                    resp = notable_data.copy()
-                                    resp.update(response.json())
-                                    _add_event(helper, resp)
-                                else:
-                                    artifacts_to_send.append(artifact)
+                                artifacts_to_post.append(artifact)
                     else:
                         artifact = artifact_from_event(helper, result, container, config, additional_keys)
                         artifact['cef']['_originating_search'] = helper.settings.get('results_link')
-                        if valid_ph_connection is True:
-                            created, artifact_id, response, c = pi.post_artifact(artifact)
-                            results.append((container, artifact))
+                        artifacts_to_post.append(artifact)
+                    if valid_ph_connection is True:
+                        # new containers get their artifacts in the same request
+                        response = pi.create_container_with_artifacts(container, artifacts_to_post)
+                        if 'Severity matching query does not exist.' in response.get('message', ''):
+                            helper.log_error("Severity label does not exist in SOAR. Sending event with artifact tag 'check_sase_severity'.")
+                            valid_ph_connection = False
+                            container['severity'] = 'high'
+                            container_to_send = container
+                            helper.severity_fail = True
+                            for artifact in artifacts_to_post:
+                                artifact['tags'] = ['check_sase_severity']
+                            artifacts_to_send.extend(artifacts_to_post)
+                        else:
+                            container_id = response.get('id')
+                            created = True
+                            if not container_id:
+                                container_id = response.get('existing_container_id')
+                                created = False
+                            if not container_id:
+                                helper.log_error(f"Unable to create container: {response.get('message')}")
+                                helper.message("", status="failure")
+                                _write_events(helper)
+                                return 1
+                            if created:
+                                _add_event(helper, response)
+                            container['id'] = container_id
                             resp = notable_data.copy()
-                            resp.update(response.json())
+                            resp.update({ 'container_id' : container['id'], 'container_url': '{}/mission/{}'.format(pi.server, container['id']), 'success': 'true' })
                             _add_event(helper, resp)
-                        else:
-                            artifacts_to_send.append(artifact)
+                            if created and pi.embeds_artifacts(artifacts_to_post):
+                                results.extend((container, artifact) for artifact in artifacts_to_post)
+                            else:
+                                for artifact in artifacts_to_post:
+                                    artifact['container_id'] = container_id
+                                posted = pi.post_artifacts(artifacts_to_post)
+                                for artifact, (created, artifact_id, response, c) in zip(artifacts_to_post, posted):
+                                    results.append((container, artifact))
+                                    resp = notable_data.copy()
+                                    resp.update(response)
+                                    _add_event(helper, resp)
+                                    if artifact_id is None and retryable_result(response):
+                                        # SOAR throttled or failed the batch, retry it later
+                                        container_to_send = dict((k, v) for k, v in container.items() if k != 'id')
+                                        artifacts_to_send.append(artifact)
+                    else:
+                        container_to_send = container
+                        artifacts_to_send.extend(artifacts_to_post)
                     if playbook:
                         payload = {
                             'run': True,
@@ -513,6 +513,14 @@ def process_event(helper, *args, **kwargs):
                                 _add_event(helper, [response.json()])
                         else:
                             playbook_to_send = payload
+                except CONNECTION_ERRORS:
+                    # this row and the ones after it go to the retry collection
+                    helper.log_error("Lost connection to SOAR. Will be posting to KV Store to retry later")
+                    valid_ph_connection = False
+                    container_to_send = dict((k, v) for k, v in container.items() if k != 'id')
+                    artifacts_to_send = artifacts_to_post
+                    if playbook:
+                        playbook_to_send = { 'run': True, 'playbook_id': playbook }
                 except:
                     helper.log_error(f"Error while creating artifacts: {format_exc()}")
                     helper.message("", status="failure")
@@ -527,14 +535,20 @@ def process_event(helper, *args, **kwargs):
                             'playbook': playbook_to_send,
                             'server_settings': server_settings['ph_auth_config_id']
                         }
-                        success, content = config.splunk.rest_kv(KV_STORE_PHANTOM_RETRY, data, "POST")
-                        helper.log_info(f"Posted to KV store for retry later: {success}. content: {content}")
+                        if save_retry_item(config.splunk, KV_STORE_PHANTOM_RETRY, data):
+                            helper.log_info("Posted to KV store for retry later")
+                        else:
+                            helper.log_error("Could not post failed data to KV store. Kept it for the retry input to post")
                     except Exception as e:
-                        helper.log_error(f"Could not post failed data to KV store. Error {format(e)}")
+                        # the checkpoint stays at this row for a rerun of the sid
+                        helper.log_error(f"Could not save failed data for retry. Error {format(e)}")
                         helper.message("", status="failure")
+                        _write_events(helper)
+                        return 1
+                # delivered, or queued for retry
+                checkpoint.commit(num + 1, [container['source_data_identifier']])
             if result.get('_phantom_workaround_description'):
                 result.pop('_phantom_workaround_description')
-            ## rate limiting
-            time.sleep(1.6)
+    checkpoint.complete()
     _write_events(helper)
     return 0
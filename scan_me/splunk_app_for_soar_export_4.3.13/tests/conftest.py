@@ -0,0 +1,13 @@
+# The tests import the modules from bin/ with SPLUNK_HOME pointing at a scratch
+# directory, so no state file of a real Splunk instance is touched. Modules that
+# import the splunk package (phantom_config, phantom_instance) are only tested
+# under Splunk's python:
+#   $SPLUNK_HOME/bin/splunk cmd python -m pytest tests
+import os
+import sys
+import tempfile
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+
+os.environ['SPLUNK_HOME'] = tempfile.mkdtemp(prefix='phantom-tests-')
+sys.path.insert(0, BIN_DIR)
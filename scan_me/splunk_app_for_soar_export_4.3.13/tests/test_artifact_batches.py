@@ -0,0 +1,96 @@
+import json
+import logging
+
+import pytest
+
+pytest.importorskip('splunk')
+
+from phantom_instance import PhantomInstance, SoarResponse, retryable_result
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode('utf-8')
+        self.headers = {}
+
+
+class FakeServer(object):
+    """Answers bulk posts with `bulk_status` and single posts by the artifact's 'bad' flag."""
+    def __init__(self, bulk_status=200):
+        self.bulk_status = bulk_status
+        self.bulk = []
+        self.single = []
+
+    def __call__(self, uri, data):
+        posted = json.loads(data)
+        if isinstance(posted, list):
+            self.bulk.append(posted)
+            if self.bulk_status != 200:
+                return SoarResponse(FakeResponse(self.bulk_status, {'failed': True, 'message': 'bulk failed'}))
+            return SoarResponse(FakeResponse(200, [{'success': True, 'id': a['n']} for a in posted]))
+        self.single.append(posted)
+        if posted.get('bad'):
+            return SoarResponse(FakeResponse(400, {'failed': True, 'message': 'bad artifact'}))
+        return SoarResponse(FakeResponse(200, {'success': True, 'id': posted['n'], 'container_id': 7}))
+
+
+def instance(monkeypatch, server, **config):
+    entry = {
+        'ph_auth_config_id': 'test', 'custom_name': 'test', 'default': False,
+        'server': 'https://batches.example', 'ph-auth-token': 'token', 'arrelay': False,
+    }
+    entry.update(config)
+    pi = PhantomInstance(entry, logging.getLogger('test'))
+    monkeypatch.setattr(pi, 'post_data', server)
+    return pi
+
+
+def artifacts(count, bad=()):
+    return [{'n': n, 'container_id': 7, 'bad': n in bad} for n in range(count)]
+
+
+def test_artifacts_are_posted_in_batches(monkeypatch):
+    server = FakeServer()
+    pi = instance(monkeypatch, server, artifact_batch_size=2)
+
+    results = pi.post_artifacts(artifacts(5))
+
+    assert [len(batch) for batch in server.bulk] == [2, 2, 1]
+    assert [r[1] for r in results] == [0, 1, 2, 3, 4]
+    assert all(r[0] for r in results)
+
+
+def test_rejected_batch_is_split_into_single_posts(monkeypatch):
+    server = FakeServer(bulk_status=400)
+    pi = instance(monkeypatch, server)
+
+    results = pi.post_artifacts(artifacts(3, bad=(1,)))
+
+    assert len(server.bulk) == 1
+    assert [a['n'] for a in server.single] == [0, 1, 2]
+    assert [r[0] for r in results] == [True, False, True]
+    assert results[1][2]['status_code'] == 400
+    assert not retryable_result(results[1][2])
+
+
+@pytest.mark.parametrize('status_code', [429, 500, 503])
+def test_throttled_or_failed_batch_is_not_split(monkeypatch, status_code):
+    server = FakeServer(bulk_status=status_code)
+    pi = instance(monkeypatch, server)
+
+    results = pi.post_artifacts(artifacts(3))
+
+    assert server.single == []
+    assert all(not r[0] and r[1] is None for r in results)
+    assert all(retryable_result(r[2]) for r in results)
+
+
+def test_rejected_single_artifact_is_not_posted_again(monkeypatch):
+    server = FakeServer(bulk_status=400)
+    pi = instance(monkeypatch, server)
+
+    results = pi.post_artifacts(artifacts(1))
+
+    assert server.single == []
+    assert results[0][2]['status_code'] == 400
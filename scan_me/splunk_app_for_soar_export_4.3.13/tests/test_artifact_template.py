@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip('splunk')
+
+from copy import deepcopy
+
+from phantom_instance import ArtifactTemplate, CONTAINER_CEF_KEYS, FINGERPRINT_KEY, NAME_KEY, NAME_OVERRIDE_KEY, SENSITIVITY_KEY, SEVERITY_KEY
+
+
+SEARCH = {NAME_KEY: 'wide notable', '_search': 'notable', '_cef_types': {'field0': ['ip']}}
+
+
+def wide_row(width=200):
+    data = dict(('field{}'.format(i), ['value {}'.format(i)] * 3) for i in range(width))
+    data['_raw'] = 'x' * 2048
+    cef = dict(data, **{SEVERITY_KEY: 'high', SENSITIVITY_KEY: 'amber', NAME_OVERRIDE_KEY: 'wide notable', FINGERPRINT_KEY: ['', 'pk']})
+    return cef, data
+
+
+def test_build_matches_a_deep_copied_cef():
+    cef, data = wide_row()
+    expected = deepcopy(cef)
+    for k in CONTAINER_CEF_KEYS:
+        expected.pop(k, None)
+
+    artifact = ArtifactTemplate(SEARCH).build(cef, data, 'pk')
+
+    assert artifact['cef'] == expected
+    assert artifact['cef_types']['field0'] == ['ip']
+    assert artifact['name'] == 'wide notable'
+    assert artifact['severity'] == 'high'
+    assert artifact['source_data_identifier'] == 'pk'
+
+
+def test_build_leaves_the_row_unchanged():
+    cef, data = wide_row()
+    before = deepcopy((cef, data))
+
+    ArtifactTemplate(SEARCH).build(cef, data, 'pk')
+
+    assert (cef, data) == before
+
+
+def test_artifacts_do_not_share_their_dicts():
+    cef, data = wide_row(3)
+    template = ArtifactTemplate(SEARCH)
+
+    first = template.build(cef, data, 'pk')
+    second = template.build(cef, data, 'pk')
+    first['cef']['added'] = 1
+    first['cef_types']['added'] = ['ip']
+
+    assert 'added' not in second['cef']
+    assert 'added' not in second['cef_types']
+    assert 'added' not in template.cef_types
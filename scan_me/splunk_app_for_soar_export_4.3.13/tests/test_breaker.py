@@ -0,0 +1,99 @@
+import time
+
+import phantom_breaker
+from phantom_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def breaker(monkeypatch, name, threshold=2, cooldown=60):
+    clock = Clock()
+    monkeypatch.setattr(phantom_breaker.time, 'time', clock)
+    return CircuitBreaker('https://{}.example'.format(name), threshold, cooldown), clock
+
+
+def test_opens_after_threshold_consecutive_failures(monkeypatch):
+    b, clock = breaker(monkeypatch, 'threshold', threshold=3)
+
+    assert not b.record_failure()
+    assert not b.record_failure()
+    assert b.state() == CLOSED and b.allow()
+    assert b.record_failure()
+    assert b.state() == OPEN
+    assert not b.allow()
+
+
+def test_success_resets_the_failure_count(monkeypatch):
+    b, clock = breaker(monkeypatch, 'reset')
+
+    b.record_failure()
+    b.record_success()
+
+    assert not b.record_failure()
+    assert b.state() == CLOSED
+
+
+def test_lets_one_probe_through_after_the_cooldown(monkeypatch):
+    b, clock = breaker(monkeypatch, 'probe')
+    b.record_failure()
+    b.record_failure()
+
+    clock.now += 59
+    assert not b.allow()
+    clock.now += 2
+    assert b.allow()
+    assert b.state() == HALF_OPEN
+    assert not b.allow()
+
+
+def test_probe_success_closes(monkeypatch):
+    b, clock = breaker(monkeypatch, 'probe-success')
+    b.record_failure()
+    b.record_failure()
+    clock.now += 61
+    b.allow()
+
+    b.record_success()
+
+    assert b.state() == CLOSED
+    assert b.allow()
+
+
+def test_probe_failure_opens_for_another_cooldown(monkeypatch):
+    b, clock = breaker(monkeypatch, 'probe-failure', threshold=5)
+    for _ in range(5):
+        b.record_failure()
+    clock.now += 61
+    b.allow()
+
+    assert b.record_failure()
+    assert b.state() == OPEN
+    assert not b.allow()
+    clock.now += 61
+    assert b.allow()
+
+
+def test_a_stuck_probe_is_replaced(monkeypatch):
+    b, clock = breaker(monkeypatch, 'stuck-probe')
+    b.record_failure()
+    b.record_failure()
+    clock.now += 61
+    b.allow()
+
+    clock.now += phantom_breaker.PROBE_TIMEOUT + 1
+
+    assert b.allow()
+
+
+def test_state_is_shared_between_instances(monkeypatch):
+    b, clock = breaker(monkeypatch, 'shared')
+    b.record_failure()
+    b.record_failure()
+
+    assert not CircuitBreaker('https://shared.example', 2, 60).allow()
@@ -0,0 +1,72 @@
+import os
+
+from phantom_checkpoint import ResultsCheckpoint
+
+
+def results_file(tmp_path):
+    # checkpoints are keyed by the sid, so every test gets its own
+    directory = tmp_path / 'scheduler__admin__search__RMD5_at_1700000000_{}'.format(tmp_path.name)
+    directory.mkdir()
+    return str(directory / 'results.csv.gz')
+
+
+def test_a_new_checkpoint_handles_nothing(tmp_path):
+    checkpoint = ResultsCheckpoint('forward', results_file(tmp_path))
+
+    assert checkpoint.resumed == 0
+    assert not checkpoint.handled(0, 'a')
+
+
+def test_resumes_after_a_partial_delivery(tmp_path):
+    path = results_file(tmp_path)
+    first = ResultsCheckpoint('forward', path)
+    first.commit(3, ['a', 'b', 'c'])
+    # row 4 was posted, row 3 is still in flight
+    first.commit(None, ['e'])
+    first.save()
+
+    second = ResultsCheckpoint('forward', path)
+
+    assert second.resumed == 3
+    assert second.handled(2)
+    assert not second.handled(3, 'd')
+    assert second.handled(4, 'e')
+
+
+def test_offset_never_moves_back(tmp_path):
+    checkpoint = ResultsCheckpoint('forward', results_file(tmp_path))
+
+    checkpoint.commit(5)
+    checkpoint.commit(2)
+
+    assert checkpoint.offset == 5
+
+
+def test_rows_committed_in_this_run_are_not_skipped(tmp_path):
+    checkpoint = ResultsCheckpoint('forward', results_file(tmp_path))
+
+    checkpoint.commit(2, ['a', 'b'])
+
+    assert not checkpoint.handled(0, 'a')
+
+
+def test_complete_removes_the_checkpoint(tmp_path):
+    path = results_file(tmp_path)
+    checkpoint = ResultsCheckpoint('forward', path)
+    checkpoint.commit(3, ['a'])
+    checkpoint.save()
+
+    checkpoint.complete()
+
+    assert not os.path.exists(checkpoint.path)
+    assert ResultsCheckpoint('forward', path).resumed == 0
+
+
+def test_checkpoints_are_per_action_and_search(tmp_path):
+    path = results_file(tmp_path)
+    checkpoint = ResultsCheckpoint('forward', path)
+    checkpoint.commit(3)
+    checkpoint.save()
+
+    assert ResultsCheckpoint('run_playbook', path).resumed == 0
+    assert ResultsCheckpoint('forward', path, sid='another_sid').resumed == 0
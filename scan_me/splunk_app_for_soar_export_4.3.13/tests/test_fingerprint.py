@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip('splunk')
+
+from phantom_instance import PhantomInstance, FINGERPRINT_KEY, NAME_KEY, NAME_OVERRIDE_KEY, PKS, SEVERITY_KEY, TAGS_KEY
+
+SEARCH = {NAME_KEY: 'failed logins'}
+
+
+def sdi(cef, search=SEARCH, fips=False):
+    return PhantomInstance._get_pk(dict(cef), search, fips)[1]
+
+
+def test_same_row_in_any_field_order_has_the_same_identifier():
+    first = {'src': '10.0.0.1', 'user': 'bob', 'count': '3'}
+    second = dict(reversed(list(first.items())))
+
+    assert sdi(first) == sdi(second)
+
+
+def test_multivalue_order_does_not_matter():
+    assert sdi({'src': ['10.0.0.1', '10.0.0.2']}) == sdi({'src': ['10.0.0.2', '10.0.0.1']})
+
+
+def test_different_values_have_different_identifiers():
+    assert sdi({'src': '10.0.0.1'}) != sdi({'src': '10.0.0.2'})
+
+
+def test_user_tags_and_container_name_are_part_of_the_identifier():
+    row = {'src': '10.0.0.1'}
+
+    assert sdi(row) != sdi(dict(row, **{TAGS_KEY: ['vip']}))
+    assert sdi(row) != sdi(dict(row, **{NAME_OVERRIDE_KEY: 'bob'}))
+
+
+def test_fallback_severity_and_generated_name_are_left_out():
+    row = {'src': '10.0.0.1'}
+
+    assert sdi(row) == sdi(dict(row, **{SEVERITY_KEY: 'medium', NAME_OVERRIDE_KEY: SEARCH[NAME_KEY]}))
+
+
+def test_primary_keys_pick_the_fields():
+    search = dict(SEARCH, **{PKS: 'user,src'})
+    pk_str, pk_hash = PhantomInstance._get_pk({'src': '10.0.0.1', 'user': 'bob', 'count': '3'}, search, False)
+
+    assert pk_str == 'src:10.0.0.1, user:bob'
+    assert pk_hash == sdi({'src': '10.0.0.1', 'user': 'bob', 'count': '4'}, search)
+
+
+def test_fips_uses_sha256():
+    row = {'src': '10.0.0.1'}
+
+    assert len(sdi(row)) == 32
+    assert len(sdi(row, fips=True)) == 64
+
+
+def test_the_result_is_kept_in_the_row():
+    cef = {'src': '10.0.0.1'}
+    first = PhantomInstance._get_pk(cef, SEARCH, False)
+    cef['src'] = '10.0.0.2'
+
+    assert cef[FINGERPRINT_KEY] == list(first)
+    assert PhantomInstance._get_pk(cef, SEARCH, False) == first
@@ -0,0 +1,59 @@
+import time
+
+import phantom_limiter
+from phantom_limiter import RateLimiter, MIN_RATE, parse_retry_after
+
+
+def test_unlimited_until_throttled():
+    limiter = RateLimiter('https://unlimited.example')
+
+    assert limiter.rate is None
+    assert limiter.update(200, 0.1) is None
+
+
+def test_throttling_halves_the_rate_and_blocks():
+    limiter = RateLimiter('https://throttled.example', max_rate=10)
+
+    rate = limiter.update(429, 0.1, '2')
+
+    assert rate == 5
+    assert limiter.blocked_until >= time.time() + 1.5
+
+
+def test_slow_responses_slow_down():
+    limiter = RateLimiter('https://slow.example', max_rate=10)
+
+    assert limiter.update(200, phantom_limiter.SLOW_RESPONSE_SECONDS + 1) == 5
+
+
+def test_rate_recovers_up_to_the_maximum():
+    limiter = RateLimiter('https://recovers.example', max_rate=2)
+    limiter.update(503, 0.1, '0')
+
+    for _ in range(10):
+        rate = limiter.update(200, 0.1)
+
+    assert rate == 2
+
+
+def test_rate_never_drops_below_the_minimum():
+    limiter = RateLimiter('https://minimum.example', max_rate=1)
+
+    for _ in range(10):
+        rate = limiter.update(429, 0.1, '0')
+
+    assert rate == MIN_RATE
+
+
+def test_new_limiters_start_from_a_saved_backoff():
+    RateLimiter('https://shared.example', max_rate=10).update(429, 0.1, '0')
+
+    assert RateLimiter('https://shared.example', max_rate=10).rate == 5
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after('-1') == 0
+    assert parse_retry_after('86400') == phantom_limiter.MAX_RETRY_AFTER
+    assert parse_retry_after('not a date') is None
+    assert parse_retry_after(None) is None
@@ -0,0 +1,47 @@
+import logging
+
+import phantom_logging
+from phantom_logging import LogSampler
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def logger(name):
+    log = logging.getLogger('phantom.tests.{}'.format(name))
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+    handler = Records()
+    log.addHandler(handler)
+    return log, handler
+
+
+def test_logs_a_burst_and_then_one_per_interval(monkeypatch):
+    log, handler = logger('burst')
+    now = [1000.0]
+    monkeypatch.setattr(phantom_logging.time, 'time', lambda: now[0])
+    sample = LogSampler(log, burst=2, interval=10)
+
+    for row in range(5):
+        sample('row %s', row)
+    now[0] += 10
+    sample('row %s', 5)
+
+    assert handler.messages == ['row 0', 'row 1', 'row 5 (3 similar messages skipped)']
+
+
+def test_nothing_is_formatted_when_the_level_is_off():
+    log, handler = logger('off')
+    log.setLevel(logging.INFO)
+    sample = LogSampler(log)
+
+    sample('row %s', 1)
+
+    assert handler.messages == []
+    assert sample.skipped == 0
@@ -0,0 +1,33 @@
+from phantom_mapping import CimCefIndex, get_cim_index
+
+
+CIM = {'src': 'sourceAddress', 'src_ip': 'sourceAddress', 'user': None}
+
+
+def test_null_cef_name_keeps_the_cim_name():
+    index = CimCefIndex(CIM)
+
+    assert index.cef_name('user') == 'user'
+    assert index.cef_name('src') == 'sourceAddress'
+    assert index.cef_name('dest', 'dest') == 'dest'
+    assert 'user' in index and 'dest' not in index
+
+
+def test_reverse_lookup_lists_every_cim_field():
+    assert CimCefIndex(CIM).cim_names('sourceAddress') == ('src', 'src_ip')
+    assert CimCefIndex(CIM).cim_names('dest') == ()
+
+
+def test_field_mapping_overrides_the_cim_mapping():
+    index = CimCefIndex(CIM, {'custom': {'cim': 'src', 'cef': 'src'}, 'broken': {'cim': 'dest'}})
+
+    assert index.cef_name('src') == 'src'
+    assert index.cim_names('sourceAddress') == ('src_ip',)
+    assert 'dest' not in index
+
+
+def test_index_is_built_once_per_field_mapping():
+    mapping = {'custom': {'cim': 'src', 'cef': 'src'}}
+
+    assert get_cim_index(mapping) is get_cim_index(dict(mapping))
+    assert get_cim_index(mapping) is not get_cim_index()
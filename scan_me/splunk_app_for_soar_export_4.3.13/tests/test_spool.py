@@ -0,0 +1,70 @@
+import gzip
+import os
+import time
+
+from phantom_spool import (Heartbeat, daemon_alive, queued_retry_items, remove_spooled, retry_spooled,
+                           save_retry_item, spool_alert, spooled_alerts, SPOOL_MAX_ATTEMPTS, SPOOL_RETRY_DELAY)
+
+
+def results_file(tmp_path):
+    path = str(tmp_path / 'results.csv.gz')
+    with gzip.open(path, 'wt') as f:
+        f.write('src\n10.0.0.1\n')
+    return path
+
+
+def test_spooled_alert_keeps_a_copy_of_the_results(tmp_path):
+    csv_path = results_file(tmp_path)
+
+    path = spool_alert('failed logins', csv_path)
+    os.remove(csv_path)
+
+    entries = dict(spooled_alerts())
+    assert entries[path]['search_name'] == 'failed logins'
+    assert os.path.isfile(entries[path]['results'])
+    remove_spooled(path)
+    assert path not in dict(spooled_alerts())
+
+
+def test_retry_delay_doubles_until_the_attempts_are_used_up(tmp_path):
+    path = spool_alert('failed logins', results_file(tmp_path))
+    entry = dict(spooled_alerts())[path]
+
+    assert retry_spooled(path, entry)
+    assert round(entry['retry_at'] - time.time()) == SPOOL_RETRY_DELAY
+    assert retry_spooled(path, entry)
+    assert round(entry['retry_at'] - time.time()) == 2 * SPOOL_RETRY_DELAY
+    while retry_spooled(path, entry):
+        pass
+    assert dict(spooled_alerts())[path]['attempts'] == SPOOL_MAX_ATTEMPTS - 1
+    remove_spooled(path)
+
+
+class KVStore(object):
+    def __init__(self, up):
+        self.up = up
+        self.posted = []
+
+    def rest_kv(self, uri, data, method):
+        if not self.up:
+            raise Exception('KV Store is not ready')
+        self.posted.append(data)
+
+
+def test_retry_items_are_kept_on_disk_when_the_kv_store_is_down():
+    assert save_retry_item(KVStore(True), 'uri', {'n': 0})
+
+    assert not save_retry_item(KVStore(False), 'uri', {'n': 1})
+    items = [item for _, item in queued_retry_items()]
+    assert items == [{'n': 1}]
+    for path, _ in queued_retry_items():
+        os.remove(path)
+
+
+def test_heartbeat_marks_the_daemon_alive():
+    heartbeat = Heartbeat()
+
+    heartbeat.beat()
+    assert daemon_alive()
+    heartbeat.stop()
+    assert not daemon_alive()
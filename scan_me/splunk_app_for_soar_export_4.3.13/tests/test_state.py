@@ -0,0 +1,63 @@
+import time
+
+import phantom_state
+from phantom_state import PersistentMap
+
+
+def test_entries_survive_a_flush(tmp_path):
+    path = str(tmp_path / 'map.json')
+    first = PersistentMap(path, 10, 60)
+    first.set('a', 1)
+    first.flush()
+
+    assert PersistentMap(path, 10, 60).get('a') == 1
+
+
+def test_flush_merges_with_other_processes(tmp_path):
+    path = str(tmp_path / 'map.json')
+    first, second = PersistentMap(path, 10, 60), PersistentMap(path, 10, 60)
+    first.get('a')
+    second.get('a')
+    first.set('a', 1)
+    second.set('b', 2)
+    first.flush()
+    second.flush()
+
+    third = PersistentMap(path, 10, 60)
+    assert (third.get('a'), third.get('b')) == (1, 2)
+
+
+def test_discard_removes_the_entry_from_the_file(tmp_path):
+    path = str(tmp_path / 'map.json')
+    first = PersistentMap(path, 10, 60)
+    first.set('a', 1)
+    first.flush()
+    second = PersistentMap(path, 10, 60)
+    second.discard('a')
+    second.flush()
+
+    assert second.get('a') is None
+    assert PersistentMap(path, 10, 60).get('a') is None
+
+
+def test_least_recently_used_entries_are_dropped(tmp_path):
+    m = PersistentMap(str(tmp_path / 'map.json'), 2, 60)
+    m.set('a', 1)
+    m.set('b', 2)
+    m.get('a')
+    m.set('c', 3)
+
+    assert (m.get('a'), m.get('b'), m.get('c')) == (1, None, 3)
+
+
+def test_entries_expire(tmp_path, monkeypatch):
+    path = str(tmp_path / 'map.json')
+    m = PersistentMap(path, 10, 60)
+    m.set('a', 1)
+    m.flush()
+
+    later = time.time() + 61
+    monkeypatch.setattr(phantom_state.time, 'time', lambda: later)
+
+    assert m.get('a') is None
+    assert PersistentMap(path, 10, 60).get('a') is None